@@ -1,13 +1,18 @@
+import asyncio
+import contextlib
 import json
 from flask import Flask, Request, Response, jsonify, request, make_response
 import dotenv
-from modules import db, llm, emb, instruments
+from modules import db, llm, emb, instruments, response_cache, usage
 from modules.turbo4 import Turbo4
 
 import os
+import shutil
+import uuid
 
 from modules.models import TurboTool
 from psycopg2 import Error as PostgresError
+from psycopg2.pool import PoolError
 
 app = Flask(__name__)
 
@@ -24,6 +29,10 @@ assert os.environ.get(
 DB_URL = os.environ.get("DATABASE_URL")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 
+# load the onnx embedding model at boot instead of on the first request
+if os.environ.get("EMBEDDINGS_WARM_UP"):
+    emb.warm_up()
+
 # ---------------- Cors Helper ----------------
 
 
@@ -68,11 +77,9 @@ def self_correcting_assistant(
 
     output_file_path = agent_instruments.run_sql_results_file
 
-    diagnosis_prompt = f"Given the table_definitions.sql file, the following SQL_ERROR, and the SQL_QUERY, describe the most likely cause of the error. Think step by step.\n\nSQL_ERROR: {error}\n\nSQL_QUERY: {sql_query}"
+    diagnosis_prompt = f"Given the following SQL_ERROR and SQL_QUERY, describe the most likely cause of the error. Think step by step.\n\nSQL_ERROR: {error}\n\nSQL_QUERY: {sql_query}"
 
-    generation_prompt = (
-        f"Based on your diagnosis, generate a new SQL query that will run successfully."
-    )
+    generation_prompt = "Given the table_definitions.sql file, the SQL_ERROR, the SQL_QUERY and the DIAGNOSIS of the error, generate a new SQL query that will run successfully."
 
     run_sql_prompt = "Use the run_sql function to run the SQL you've just generated."
 
@@ -82,43 +89,104 @@ def self_correcting_assistant(
 
     print(f"Generated Assistant: {assistant_name}")
 
-    file_ids = turbo4_assistant.upsert_files(files_to_upload)
+    print(f"Running Self Correction Assistant...")
 
-    print(f"Uploaded files: {file_ids}")
+    with usage.attribute(agent_instruments.session_id, team=assistant_name):
+        # the diagnosis only needs the error and the query - run it while the files upload
+        diagnosis, file_ids = llm.run_concurrently(
+            llm.aprompt(
+                diagnosis_prompt,
+                model="gpt-4-1106-preview",
+                instructions="You're an elite SQL developer. You diagnose why SQL queries fail.",
+            ),
+            asyncio.to_thread(turbo4_assistant.upsert_files, files_to_upload),
+        )
 
-    print(f"Running Self Correction Assistant...")
+        print(f"Uploaded files: {file_ids}")
 
-    (
-        turbo4_assistant.set_instructions(
-            "You're an elite SQL developer. You generate the most concise and performant SQL queries. You review failed queries and generate new SQL queries to fix them."
+        (
+            turbo4_assistant.set_instructions(
+                "You're an elite SQL developer. You generate the most concise and performant SQL queries. You review failed queries and generate new SQL queries to fix them."
+            )
+            .enable_retrieval()
+            .equip_tools(tools)
+            .make_thread()
+            # 1/2 STEP PATTERN: generate from the diagnosis
+            .add_message(
+                f"{generation_prompt}\n\nSQL_ERROR: {error}\n\nSQL_QUERY: {sql_query}\n\nDIAGNOSIS: {diagnosis}",
+                file_ids=file_ids,
+            )
+            .run_thread()
+            .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
+            # 2/2 STEP PATTERN: execute
+            .add_message(run_sql_prompt)
+            .run_thread(toolbox=[tools[0].name])
+            .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
+            # clean up, logging, reporting, cost
+            .run_validation(agent_instruments.validate_file_exists(output_file_path))
+            .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
+            .get_costs_and_tokens(
+                agent_instruments.make_agent_cost_file(assistant_name)
+            )
         )
-        .enable_retrieval()
-        .equip_tools(tools)
-        .make_thread()
-        # 1/3 STEP PATTERN: diagnose
-        .add_message(diagnosis_prompt, file_ids=file_ids)
-        .run_thread()
-        .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
-        # 2/3 STEP PATTERN: generate
-        .add_message(generation_prompt)
-        .run_thread()
-        .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
-        # 3/3 STEP PATTERN: execute
-        .add_message(run_sql_prompt)
-        .run_thread(toolbox=[tools[0].name])
-        .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
-        # clean up, logging, reporting, cost
-        .run_validation(agent_instruments.validate_file_exists(output_file_path))
-        .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
-        .get_costs_and_tokens(agent_instruments.make_agent_cost_file(assistant_name))
-    )
 
     pass
 
 
+# ---------------- Response Cache ----------------
+
+
+def run_cached_sql(
+    db: db.PostgresManager,
+    agent_instruments: instruments.PostgresAgentInstruments,
+    cache: response_cache.ResponseCache,
+    base_prompt: str,
+    schema_fingerprint: str,
+    embed_prompt,
+) -> bool:
+    """
+    Run the cached SQL for a prompt, skipping the LLM entirely.
+    False on a miss or when the cached SQL no longer runs.
+    """
+    cached = cache.get(base_prompt, schema_fingerprint, embed_prompt)
+    if cached is None:
+        return False
+    cached_key, cached_sql = cached
+
+    print(f"Response cache hit for prompt: {base_prompt}")
+
+    try:
+        agent_instruments.run_sql(cached_sql)
+    except PoolError:
+        # no connection to be had - not a problem with the cached SQL
+        raise
+    except PostgresError as e:
+        print(f"Cached SQL failed, regenerating: {e}")
+        db.roll_back()
+        cache.delete(cached_key)
+        return False
+
+    return agent_instruments.validate_run_sql()[0]
+
+
 # ---------------- Primary Endpoint ----------------
 
 
+@contextlib.contextmanager
+def request_session():
+    """
+    A session id per request. Its files and usage totals are dropped once the request is done.
+    """
+    session_id = f"prompt-endpoint-{uuid.uuid4().hex}"
+    try:
+        yield session_id
+    finally:
+        shutil.rmtree(
+            os.path.join(instruments.BASE_DIR, session_id), ignore_errors=True
+        )
+        usage.ledger.pop_session_totals(session_id)
+
+
 @app.route("/prompt", methods=["POST", "OPTIONS"])
 def prompt():
     # Set CORS headers for the main request
@@ -126,67 +194,98 @@ def prompt():
     if request.method == "OPTIONS":
         return response
 
-    # Get access to db, state, and functions
-    with instruments.PostgresAgentInstruments(DB_URL, "prompt-endpoint") as (
-        agent_instruments,
-        db,
-    ):
+    # Get access to db, state, and functions - a session per request so concurrent
+    # requests get their own files and usage totals
+    with request_session() as session_id, instruments.PostgresAgentInstruments(
+        DB_URL, session_id
+    ) as (agent_instruments, db):
         # ---------------- Build Prompt ----------------
 
         base_prompt = request.json["prompt"]
 
-        # simple word match for now - dropped embeddings for deployment size
-        similar_tables = emb.DatabaseEmbedder(db).get_similar_table_defs_for_prompt(
-            base_prompt
+        # ---------------- Response Cache - Skip The LLM For Repeated Prompts ----------------
+
+        database_embedder = emb.DatabaseEmbedder(db)
+        schema_fingerprint = db.get_schema_fingerprint()
+        cache = response_cache.get_response_cache()
+
+        def embed_prompt():
+            # only called on an exact miss when the similarity tier is on
+            if database_embedder.embedding_model is None:
+                return None
+            return database_embedder.get_query_embedding(base_prompt)
+
+        cache_hit = run_cached_sql(
+            db,
+            agent_instruments,
+            cache,
+            base_prompt,
+            schema_fingerprint,
+            embed_prompt,
         )
 
-        if len(similar_tables) == 0:
-            print(f"No similar tables found for prompt: {base_prompt}")
-            response.status_code = 400
-            response.data = "No similar tables found."
-            return response
-
-        print("similar_tables", similar_tables)
-
-        print(f"base_prompt: {base_prompt}")
+        if not cache_hit:
+            # int8 onnx embeddings + word match - see modules/onnx_embeddings.py
+            similar_tables = database_embedder.get_similar_table_defs_for_prompt(
+                base_prompt
+            )
 
-        prompt = f"Fulfill this database query: {base_prompt}. "
-        prompt = llm.add_cap_ref(
-            prompt,
-            f"Use these TABLE_DEFINITIONS to satisfy the database query.",
-            "TABLE_DEFINITIONS",
-            similar_tables,
-        )
+            if len(similar_tables) == 0:
+                print(f"No similar tables found for prompt: {base_prompt}")
+                response.status_code = 400
+                response.data = "No similar tables found."
+                return response
 
-        # ---------------- Run 2 Agent Team - Generate SQL & Results ----------------
+            print("similar_tables", similar_tables)
 
-        tools = [
-            TurboTool("run_sql", llm.run_sql_tool_config, agent_instruments.run_sql),
-        ]
+            print(f"base_prompt: {base_prompt}")
 
-        sql_response = llm.prompt(
-            prompt,
-            model="gpt-4-1106-preview",
-            instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
-        )
-        try:
-            llm.prompt_func(
-                "Use the run_sql function to run the SQL you've just generated: "
-                + sql_response,
-                model="gpt-4-1106-preview",
-                instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
-                turbo_tools=tools,
-            )
-            agent_instruments.validate_run_sql()
-        except PostgresError as e:
-            print(
-                f"Received PostgresError -> Running Self Correction Team To Resolve: {e}"
+            prompt = f"Fulfill this database query: {base_prompt}. "
+            prompt = llm.add_cap_ref(
+                prompt,
+                f"Use these TABLE_DEFINITIONS to satisfy the database query.",
+                "TABLE_DEFINITIONS",
+                similar_tables,
             )
 
-            # ---------------- Run Self Correction Team - Diagnosis, Generate New SQL, Retry ----------------
-            self_correcting_assistant(db, agent_instruments, tools, e)
-
-            print(f"Self Correction Team Complete.")
+            # ---------------- Run 2 Agent Team - Generate SQL & Results ----------------
+
+            tools = [
+                TurboTool(
+                    "run_sql", llm.run_sql_tool_config, agent_instruments.run_sql
+                ),
+            ]
+
+            with usage.attribute(agent_instruments.session_id, team="sql_generation"):
+                sql_response = llm.prompt(
+                    prompt,
+                    model="gpt-4-1106-preview",
+                    instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
+                )
+            try:
+                with usage.attribute(
+                    agent_instruments.session_id, team="sql_generation"
+                ):
+                    llm.prompt_func(
+                        "Use the run_sql function to run the SQL you've just generated: "
+                        + sql_response,
+                        model="gpt-4-1106-preview",
+                        instructions="You're an elite SQL developer. You generate the most concise and performant SQL queries.",
+                        turbo_tools=tools,
+                    )
+                agent_instruments.validate_run_sql()
+            except PoolError:
+                # pool exhausted - self correction can't fix that
+                raise
+            except PostgresError as e:
+                print(
+                    f"Received PostgresError -> Running Self Correction Team To Resolve: {e}"
+                )
+
+                # ---------------- Run Self Correction Team - Diagnosis, Generate New SQL, Retry ----------------
+                self_correcting_assistant(db, agent_instruments, tools, e)
+
+                print(f"Self Correction Team Complete.")
 
         # ---------------- Read result files and respond ----------------
 
@@ -199,8 +298,16 @@ def prompt():
             "sql": sql_query,
         }
 
+        if not cache_hit and agent_instruments.validate_run_sql()[0]:
+            prompt_embedding = (
+                embed_prompt() if cache.similarity_threshold is not None else None
+            )
+            cache.put(base_prompt, schema_fingerprint, sql_query, prompt_embedding)
+
         print("response_obj", response_obj)
 
+        print("usage", usage.ledger.get_session_totals(agent_instruments.session_id))
+
         response.data = json.dumps(response_obj)
 
         return response
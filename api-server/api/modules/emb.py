@@ -1,4 +1,54 @@
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from modules import column_pruning, embedding_store, retrieval
 from modules.db import PostgresManager
+from modules.models import TableColumn
+from modules.onnx_embeddings import OnnxEmbeddingModel
+from modules.token_index import TokenIndex
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 32))
+
+# int8 onnx export of bert-base-uncased - see modules/onnx_embeddings.py
+# without it the embedder falls back to word matching only
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "./models/bert-base-uncased-onnx")
+
+_embedding_model: Optional[OnnxEmbeddingModel] = None
+
+
+def get_embedding_model() -> Optional[OnnxEmbeddingModel]:
+    """
+    Process wide onnx model, None if it hasn't been exported to ONNX_MODEL_DIR.
+    """
+    global _embedding_model
+    if _embedding_model is None and os.path.isdir(ONNX_MODEL_DIR):
+        _embedding_model = OnnxEmbeddingModel(ONNX_MODEL_DIR)
+    return _embedding_model
+
+
+def warm_up():
+    """
+    Load the onnx model at boot so the first request doesn't pay for it.
+    """
+    embedding_model = get_embedding_model()
+    if embedding_model is not None:
+        embedding_model.embed(["warm up"], 1)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=int)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
 
 
 class DatabaseEmbedder:
@@ -8,24 +58,51 @@ class DatabaseEmbedder:
     """
 
     def __init__(self, db: PostgresManager):
-        self.map_name_to_embeddings = {}
+        self.embedding_model = get_embedding_model()
         self.map_name_to_table_def = {}
+        # columns with key flags, known when tables come from a schema snapshot
+        self.map_name_to_columns: Dict[str, List[TableColumn]] = {}
+        self.table_names: List[str] = []
+        # unit length embeddings, row i belongs to table_names[i]
+        self.normalized_table_embeddings = np.zeros((0, 0), dtype=np.float32)
+        # the prompt is embedded once and reused for table and column scoring
+        self.last_query = None
+        self.last_query_embedding = None
+        # table and column name tokens for word matching
+        self.token_index = TokenIndex()
+        # table names, column names and comments for keyword retrieval
+        self.bm25_index = retrieval.BM25Index()
         self.db = db
 
     def get_similar_table_defs_for_prompt(self, prompt: str, n_similar=5, n_foreign=0):
-        map_table_name_to_table_def = self.db.get_table_definition_map_for_embeddings()
-        for name, table_def in map_table_name_to_table_def.items():
-            self.add_table(name, table_def)
+        snapshot = self.db.get_schema_snapshot()
+        self.add_tables(
+            snapshot.table_definitions,
+            {
+                table_name: retrieval.make_table_document_from_columns(
+                    table_name, columns, snapshot.table_comments.get(table_name)
+                )
+                for table_name, columns in snapshot.table_columns.items()
+            },
+        )
+        self.map_name_to_columns.update(snapshot.table_columns)
 
         similar_tables = self.get_similar_tables(prompt, n=n_similar)
 
-        table_definitions = self.get_table_definitions_from_names(similar_tables)
+        table_definitions = self.get_pruned_table_definitions_from_names(
+            similar_tables, prompt
+        )
 
         if n_foreign > 0:
-            foreign_table_names = self.db.get_foreign_tables(similar_tables, n=3)
+            graph = self.db.get_foreign_key_graph()
+            # tables needed to join the similar ones, then their direct neighbours
+            join_table_names = graph.get_join_path_tables(similar_tables)
+            foreign_table_names = join_table_names + graph.get_related_tables(
+                similar_tables + join_table_names, n=n_foreign
+            )
 
-            table_definitions = self.get_table_definitions_from_names(
-                foreign_table_names + similar_tables
+            table_definitions = self.get_pruned_table_definitions_from_names(
+                foreign_table_names + similar_tables, prompt
             )
 
         return table_definitions
@@ -35,17 +112,52 @@ class DatabaseEmbedder:
         Add a table to the database embedder.
         Map the table name to its embedding and text representation.
         """
-        self.map_name_to_embeddings[table_name] = self.compute_embeddings(
-            text_representation
-        )
+        self.add_tables({table_name: text_representation})
+
+    def add_tables(
+        self,
+        map_table_name_to_table_def: Dict[str, str],
+        map_table_name_to_document: Optional[Dict[str, str]] = None,
+    ):
+        """
+        Add many tables to the database embedder.
+        Embeddings are cached on disk by content hash, so only new or changed tables are embedded.
+
+        map_table_name_to_document is the text keyword retrieval indexes per table
+        (names and comments), built from the definitions when not given.
+        """
+        self.map_name_to_table_def.update(map_table_name_to_table_def)
+        self.token_index.add_tables(map_table_name_to_table_def)
+
+        if map_table_name_to_document is None:
+            map_table_name_to_document = {
+                table_name: retrieval.make_table_document_from_definition(
+                    table_name, table_def
+                )
+                for table_name, table_def in map_table_name_to_table_def.items()
+            }
+        self.bm25_index.add_documents(map_table_name_to_document)
 
-        self.map_name_to_table_def[table_name] = text_representation
+        if self.embedding_model is None:
+            return
+
+        self.table_names = list(self.map_name_to_table_def.keys())
+        store = embedding_store.get_embedding_store(self.embedding_model.name)
+        embeddings = store.get_embeddings(
+            self.table_names,
+            list(self.map_name_to_table_def.values()),
+            self.compute_embeddings_batch,
+        )
+        self.normalized_table_embeddings = normalize_rows(embeddings)
 
     def compute_embeddings(self, text):
         """
-        Compute embeddings for a given text using the BERT model.
+        Compute embeddings for a given text using the onnx BERT model.
         """
-        return ""
+        return self.compute_embeddings_batch([text])
+
+    def compute_embeddings_batch(self, texts: List[str]) -> np.ndarray:
+        return self.embedding_model.embed(texts, EMBEDDING_BATCH_SIZE)
 
     def get_similar_tables_via_embeddings(self, query, n=3):
         """
@@ -58,32 +170,78 @@ class DatabaseEmbedder:
         Returns:
         - list: Top 'n' table names ranked by their similarity to the query.
         """
-        return []
+        if self.embedding_model is None or not self.table_names:
+            return []
 
-    def get_similar_table_names_via_word_match(self, query: str):
+        scores = self.normalized_table_embeddings @ self.get_query_embedding(query)
+        return [self.table_names[i] for i in top_k_indices(scores, n)]
+
+    def get_query_embedding(self, query: str) -> np.ndarray:
         """
-        if any word in our query is a table name, add the table to a list
+        Unit length embedding of the query, computed once per distinct query.
         """
+        if query != self.last_query:
+            query_embeddings = normalize_rows(self.compute_embeddings(query))
+            self.last_query_embedding = query_embeddings[0]
+            self.last_query = query
+        return self.last_query_embedding
 
-        tables = []
+    def get_column_similarity_scores(
+        self, table_name: str, columns: List[TableColumn], query: str
+    ) -> Optional[np.ndarray]:
+        """
+        Cosine similarity between the query and every column of a table, aligned with columns.
+        None without the onnx model.
+        """
+        if self.embedding_model is None:
+            return None
 
-        for table_name in self.map_name_to_table_def.keys():
-            if table_name.lower() in query.lower():
-                tables.append(table_name)
+        store = embedding_store.get_embedding_store(self.embedding_model.name)
+        embeddings = store.get_embeddings(
+            [f"{table_name}.{column.name}" for column in columns],
+            [column_pruning.make_column_text(table_name, column) for column in columns],
+            self.compute_embeddings_batch,
+        )
+        return normalize_rows(embeddings) @ self.get_query_embedding(query)
+
+    def get_similar_table_names_via_word_match(self, query: str):
+        """
+        if every word of a table name is in our query, add the table to a list
 
-        return tables
+        Table names and the query are both split on snake_case and camelCase
+        and stemmed, so 'order items' matches 'OrderItems' and 'order_items'.
+        """
+        return self.token_index.match_table_names(query)
+
+    def get_word_match_scores(self, query: str) -> Dict[str, float]:
+        """
+        Word match score of every table sharing a table or column name token with the query.
+        """
+        return self.token_index.get_scores(query)
 
     def get_similar_tables(self, query: str, n=3):
         """
-        combines results from get_similar_tables_via_embeddings and get_similar_table_names_via_word_match
+        Hybrid retrieval: fuses the embedding ranking (when the onnx model is available)
+        with the BM25 ranking through reciprocal rank fusion, keeps the top 'n' fused tables,
+        then adds any table named in the query.
+
+        Returns a de-duplicated list of table names, best first.
         """
+        n_candidates = n * retrieval.RETRIEVAL_CANDIDATES
 
-        similar_tables_via_embeddings = self.get_similar_tables_via_embeddings(query, n)
-        similar_tables_via_word_match = self.get_similar_table_names_via_word_match(
-            query
+        fused = retrieval.reciprocal_rank_fusion(
+            [
+                self.get_similar_tables_via_embeddings(query, n_candidates),
+                self.bm25_index.rank(query, n_candidates),
+            ]
         )
+        similar_tables = retrieval.cut_off(fused, n)
 
-        return similar_tables_via_embeddings + similar_tables_via_word_match
+        for table_name in self.get_similar_table_names_via_word_match(query):
+            if table_name not in similar_tables:
+                similar_tables.append(table_name)
+
+        return similar_tables
 
     def get_table_definitions_from_names(self, table_names: list) -> str:
         """
@@ -93,3 +251,33 @@ class DatabaseEmbedder:
             self.map_name_to_table_def[table_name] for table_name in table_names
         ]
         return "\n\n".join(table_defs)
+
+    def get_pruned_table_definitions_from_names(
+        self, table_names: list, query: str, n_columns=column_pruning.COLUMN_PRUNE_TOP_N
+    ) -> str:
+        """
+        Given a list of table names, return their table definitions for a query.
+
+        Tables wider than COLUMN_PRUNE_MIN_COLUMNS are cut down to their key columns,
+        the columns named in the query and the 'n_columns' columns most similar to it.
+        """
+        table_defs = []
+        for table_name in table_names:
+            columns = self.map_name_to_columns.get(table_name)
+            if (
+                columns is None
+                or len(columns) <= column_pruning.COLUMN_PRUNE_MIN_COLUMNS
+            ):
+                table_defs.append(self.map_name_to_table_def[table_name])
+                continue
+
+            scores = self.get_column_similarity_scores(table_name, columns, query)
+            kept_columns = column_pruning.select_columns(
+                columns, query, scores, n_columns
+            )
+            table_defs.append(
+                column_pruning.make_pruned_table_definition(
+                    table_name, kept_columns, len(columns)
+                )
+            )
+        return "\n\n".join(table_defs)
@@ -1,4 +1,6 @@
 import json
+import os
+import threading
 
 
 def write_file(fname, content):
@@ -6,6 +8,16 @@ def write_file(fname, content):
         f.write(content)
 
 
+def write_file_atomic(fname, content):
+    """
+    Write through a temp file so readers see the old or the new content, never a mix.
+    """
+    tmp_fname = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_fname, "w") as f:
+        f.write(content)
+    os.replace(tmp_fname, fname)
+
+
 def write_json_file(fname, json_str: str):
     # convert ' to "
     json_str = json_str.replace("'", '"')
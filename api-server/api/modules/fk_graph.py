@@ -0,0 +1,140 @@
+"""
+Purpose:
+    In-memory foreign key graph of the public schema, built once per schema snapshot.
+    Answers 'which tables are related within k hops' and 'which tables are needed
+    to join these' without another catalog query.
+"""
+
+from collections import deque
+from typing import Dict, List, Optional, Set
+
+from modules.models import ForeignKey
+
+
+class ForeignKeyGraph:
+    """
+    Undirected adjacency over foreign keys. Every edge remembers the
+    foreign key it came from so join paths can be walked back.
+    """
+
+    def __init__(self, foreign_keys: List[ForeignKey], fingerprint: str = ""):
+        self.fingerprint = fingerprint
+        # table -> tables referencing it
+        self.referencing: Dict[str, List[str]] = {}
+        # table -> tables it references
+        self.referenced: Dict[str, List[str]] = {}
+        # table -> neighbour -> foreign key joining the two
+        self.edges: Dict[str, Dict[str, ForeignKey]] = {}
+
+        for foreign_key in foreign_keys:
+            table_name = foreign_key.table_name
+            foreign_table_name = foreign_key.foreign_table_name
+
+            if foreign_table_name not in self.edges.get(table_name, {}):
+                self.referenced.setdefault(table_name, []).append(foreign_table_name)
+            if table_name not in self.edges.get(foreign_table_name, {}):
+                self.referencing.setdefault(foreign_table_name, []).append(table_name)
+
+            self.edges.setdefault(table_name, {})[foreign_table_name] = foreign_key
+            self.edges.setdefault(foreign_table_name, {})[table_name] = foreign_key
+
+    def neighbours(self, table_name: str, n: Optional[int] = None) -> List[str]:
+        """
+        Up to n tables referencing table_name and up to n tables it references.
+        """
+        referencing = self.referencing.get(table_name, [])
+        referenced = self.referenced.get(table_name, [])
+        if n is not None:
+            referencing, referenced = referencing[:n], referenced[:n]
+        return referencing + [name for name in referenced if name not in referencing]
+
+    def get_related_tables(
+        self, table_names: List[str], n: Optional[int] = None, hops: int = 1
+    ) -> List[str]:
+        """
+        Tables within 'hops' foreign keys of any of table_names, nearest first.
+        n limits the neighbours followed per direction per table.
+        The given tables themselves are not returned.
+        """
+        seen = set(table_names)
+        related = []
+        frontier = list(table_names)
+
+        for _ in range(hops):
+            next_frontier = []
+            for table_name in frontier:
+                for neighbour in self.neighbours(table_name, n):
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        related.append(neighbour)
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+
+        return related
+
+    def find_path(self, source: str, targets: Set[str]) -> Optional[List[ForeignKey]]:
+        """
+        Breadth first search from source to the nearest of targets.
+        """
+        if source in targets:
+            return []
+
+        # child -> parent in the search tree, the source is its own parent
+        previous: Dict[str, str] = {source: source}
+        queue = deque([source])
+        while queue:
+            table_name = queue.popleft()
+            for neighbour in self.edges.get(table_name, {}):
+                if neighbour in previous:
+                    continue
+                previous[neighbour] = table_name
+                if neighbour in targets:
+                    return self.walk_back(previous, neighbour)
+                queue.append(neighbour)
+
+        return None
+
+    def walk_back(self, previous: Dict[str, str], table_name: str) -> List[ForeignKey]:
+        path = []
+        while previous[table_name] != table_name:
+            path.append(self.edges[previous[table_name]][table_name])
+            table_name = previous[table_name]
+        path.reverse()
+        return path
+
+    def get_join_paths(self, table_names: List[str]) -> List[ForeignKey]:
+        """
+        Foreign keys connecting table_names to each other.
+
+        Grows a tree from the first table: each further table is joined to the
+        nearest table already in the tree along a shortest path (a cheap Steiner
+        tree approximation). Tables in another component are skipped.
+        """
+        join_paths: List[ForeignKey] = []
+        if not table_names:
+            return join_paths
+
+        tree = {table_names[0]}
+        for table_name in table_names[1:]:
+            path = self.find_path(table_name, tree)
+            if path is None:
+                continue
+
+            for foreign_key in path:
+                tree.update([foreign_key.table_name, foreign_key.foreign_table_name])
+                if foreign_key not in join_paths:
+                    join_paths.append(foreign_key)
+            tree.add(table_name)
+
+        return join_paths
+
+    def get_join_path_tables(self, table_names: List[str]) -> List[str]:
+        """
+        Tables that are not in table_names but are needed to join them together.
+        """
+        bridge_tables = []
+        for foreign_key in self.get_join_paths(table_names):
+            for table_name in (foreign_key.table_name, foreign_key.foreign_table_name):
+                if table_name not in table_names and table_name not in bridge_tables:
+                    bridge_tables.append(table_name)
+        return bridge_tables
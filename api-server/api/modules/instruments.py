@@ -1,7 +1,9 @@
 import json
-from modules.db import PostgresManager
+from modules.db import PostgresManager, get_pool
 from modules import file
+import contextlib
 import os
+import threading
 
 BASE_DIR = os.environ.get("BASE_DIR", "./agent_results")
 
@@ -55,14 +57,22 @@ class PostgresAgentInstruments(AgentInstruments):
         - The state lifecycle lives between all agent orchestrations
     """
 
-    def __init__(self, db_url: str, session_id: str) -> None:
+    def __init__(self, db_url: str, session_id: str, pooled: bool = True) -> None:
         super().__init__()
 
         self.db_url = db_url
+        self.pooled = pooled
         self.db = None
         self.session_id = session_id
         self.messages = []
         self.innovation_index = 0
+        # agent functions may be called from several threads at once, see llm.run_tool_calls
+        self.lock = threading.Lock()
+        # held while an agent function call runs on self.db, see borrow_db
+        self.db_lock = threading.Lock()
+        # run_sql calls started / the call whose results are in the results file
+        self.run_sql_count = 0
+        self.last_run_sql_index = 0
 
     def __enter__(self):
         """
@@ -70,7 +80,10 @@ class PostgresAgentInstruments(AgentInstruments):
         """
         self.reset_files()
         self.db = PostgresManager()
-        self.db.connect_with_url(self.db_url)
+        if self.pooled:
+            self.db.connect_with_pool(get_pool(self.db_url))
+        else:
+            self.db.connect_with_url(self.db_url)
         return self, self.db
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -85,6 +98,29 @@ class PostgresAgentInstruments(AgentInstruments):
         """
         self.messages = messages
 
+    @contextlib.contextmanager
+    def borrow_db(self):
+        """
+        A database connection for a single agent function call.
+        Calls run on self.db while it's free. Concurrent pooled calls borrow an extra
+        connection, unpooled ones wait their turn on self.db.
+        """
+        if not self.pooled:
+            with self.db_lock:
+                yield self.db
+            return
+
+        if self.db_lock.acquire(blocking=False):
+            try:
+                yield self.db
+            finally:
+                self.db_lock.release()
+            return
+
+        with PostgresManager() as db:
+            db.connect_with_pool(get_pool(self.db_url))
+            yield db
+
     def reset_files(self):
         """
         Clear everything in the root_dir
@@ -122,18 +158,31 @@ class PostgresAgentInstruments(AgentInstruments):
     def run_sql(self, sql: str) -> str:
         """
         Run a SQL query against the postgres database
-        """
-
-        with open(self.sql_query_file, "w") as f:
-            f.write(sql)
-
-        results_as_json = self.db.run_sql(sql)
 
+        Safe to call from several threads at once - each call runs on its own connection
+        (see borrow_db) and streams into its own temp file. The sql and results files are then swapped in
+        together, so they always match and hold the latest started call.
+        """
         fname = self.run_sql_results_file
 
-        # dump these results to a file
-        with open(fname, "w") as f:
-            f.write(results_as_json)
+        with self.lock:
+            self.run_sql_count += 1
+            run_sql_index = self.run_sql_count
+        tmp_fname = f"{fname}.{run_sql_index}.tmp"
+
+        try:
+            # stream the results into the file batch by batch
+            with self.borrow_db() as db:
+                db.run_sql_to_file(sql, tmp_fname)
+
+            with self.lock:
+                if run_sql_index > self.last_run_sql_index:
+                    self.last_run_sql_index = run_sql_index
+                    file.write_file_atomic(self.sql_query_file, sql)
+                    os.replace(tmp_fname, fname)
+        finally:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
 
         return "Successfully delivered results to json file"
 
@@ -160,9 +209,11 @@ class PostgresAgentInstruments(AgentInstruments):
         return file.write_json_file(fname, json_str)
 
     def write_innovation_file(self, content: str):
-        fname = self.get_file_path(f"{self.innovation_index}_innovation_file.json")
+        with self.lock:
+            innovation_index = self.innovation_index
+            self.innovation_index += 1
+        fname = self.get_file_path(f"{innovation_index}_innovation_file.json")
         file.write_file(fname, content)
-        self.innovation_index += 1
         return f"Successfully wrote innovation file. You can check my work."
 
     def validate_innovation_files(self):
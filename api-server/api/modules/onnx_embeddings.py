@@ -0,0 +1,111 @@
+"""
+Purpose:
+    CPU embedding backend that runs an exported, int8 quantized BERT encoder
+    through onnxruntime. Needs only numpy, onnxruntime and tokenizers - no torch.
+
+    Export the model once with:
+        python -m postgres_da_ai_agent.export_onnx --output-dir <ONNX_MODEL_DIR>  (from the repo root)
+"""
+
+import os
+import threading
+from typing import List
+
+import numpy as np
+
+ONNX_MODEL_FILE = "model.int8.onnx"
+ONNX_TOKENIZER_FILE = "tokenizer.json"
+ONNX_MAX_LENGTH = 512
+ONNX_NUM_THREADS = int(os.environ.get("ONNX_NUM_THREADS", 0))  # 0 = onnxruntime default
+
+
+class OnnxEmbeddingModel:
+    """
+    Quantized encoder loaded once, on first use, and shared across threads.
+    Same embed() contract as the BERT EmbeddingModel - pooler output per text.
+    """
+
+    def __init__(self, model_dir: str, model_file: str = ONNX_MODEL_FILE):
+        self.model_dir = model_dir
+        self.model_file = model_file
+        self.name = f"{os.path.basename(os.path.normpath(model_dir))}-{model_file}"
+        self.lock = threading.Lock()
+        self.session = None
+        self.tokenizer = None
+        self.input_names: List[str] = []
+
+    def load(self):
+        if self.session is not None:
+            return self
+        with self.lock:
+            if self.session is None:
+                import onnxruntime
+                from tokenizers import Tokenizer
+
+                print(
+                    f"Loading onnx embedding model {self.model_dir}/{self.model_file}"
+                )
+
+                tokenizer = Tokenizer.from_file(
+                    os.path.join(self.model_dir, ONNX_TOKENIZER_FILE)
+                )
+                tokenizer.enable_truncation(ONNX_MAX_LENGTH)
+                tokenizer.no_padding()
+
+                options = onnxruntime.SessionOptions()
+                if ONNX_NUM_THREADS:
+                    options.intra_op_num_threads = ONNX_NUM_THREADS
+                session = onnxruntime.InferenceSession(
+                    os.path.join(self.model_dir, self.model_file),
+                    options,
+                    providers=["CPUExecutionProvider"],
+                )
+
+                self.tokenizer = tokenizer
+                self.input_names = [i.name for i in session.get_inputs()]
+                self.session = session
+        return self
+
+    @property
+    def hidden_size(self) -> int:
+        outputs = self.load().session.get_outputs()
+        return next(o.shape[-1] for o in outputs if o.name == "pooler_output")
+
+    def embed(self, texts: List[str], batch_size: int) -> np.ndarray:
+        """
+        Embed texts in length sorted, padded mini-batches into one (len(texts), hidden_size) matrix.
+        """
+        self.load()
+
+        encodings = self.tokenizer.encode_batch(texts)
+        order = sorted(range(len(texts)), key=lambda i: len(encodings[i].ids))
+
+        embeddings = None
+        for start in range(0, len(order), batch_size):
+            batch_indices = order[start : start + batch_size]
+            batch = [encodings[i] for i in batch_indices]
+            length = max(len(encoding.ids) for encoding in batch)
+
+            inputs = {
+                name: np.zeros((len(batch), length), dtype=np.int64)
+                for name in ("input_ids", "attention_mask", "token_type_ids")
+            }
+            for row, encoding in enumerate(batch):
+                size = len(encoding.ids)
+                inputs["input_ids"][row, :size] = encoding.ids
+                inputs["attention_mask"][row, :size] = encoding.attention_mask
+                inputs["token_type_ids"][row, :size] = encoding.type_ids
+
+            # pooler_output is the second output, after last_hidden_state
+            outputs = self.session.run(
+                ["pooler_output"], {name: inputs[name] for name in self.input_names}
+            )[0]
+
+            if embeddings is None:
+                embeddings = np.empty((len(texts), outputs.shape[1]), dtype=np.float32)
+            embeddings[batch_indices] = outputs
+
+        if embeddings is None:
+            embeddings = np.empty((0, self.hidden_size), dtype=np.float32)
+
+        return embeddings
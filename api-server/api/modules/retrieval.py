@@ -0,0 +1,184 @@
+"""
+Purpose:
+    Hybrid table retrieval. A BM25 index over table names, column names and
+    comments is fused with the embedding ranking through reciprocal rank fusion.
+    Weak BM25 hits are dropped on their raw score before the fusion - fused scores
+    only reflect ranks, so they can't tell a relevant table from an irrelevant one.
+"""
+
+import math
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from modules.token_index import parse_column_names, tokenize
+from modules.models import TableColumn
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# standard reciprocal rank fusion constant - damps the weight of the very first ranks
+RRF_K = int(os.environ.get("RRF_K", 60))
+# each ranking contributes its top n * RETRIEVAL_CANDIDATES tables to the fusion
+RETRIEVAL_CANDIDATES = int(os.environ.get("RETRIEVAL_CANDIDATES", 4))
+# BM25 hits scoring below this fraction of the best BM25 score are dropped before the fusion
+RETRIEVAL_MIN_RELATIVE_SCORE = float(
+    os.environ.get("RETRIEVAL_MIN_RELATIVE_SCORE", 0.5)
+)
+
+
+def make_table_document(
+    table_name: str,
+    column_names: List[str],
+    table_comment: Optional[str] = None,
+    column_comments: Optional[List[str]] = None,
+) -> str:
+    """
+    Text indexed by BM25 for a table. The table name is repeated so a name hit outweighs a column hit.
+    """
+    parts = [table_name, table_name] + column_names
+    if table_comment:
+        parts.append(table_comment)
+    parts += [comment for comment in column_comments or [] if comment]
+    return "\n".join(parts)
+
+
+def make_table_document_from_columns(
+    table_name: str, columns: List[TableColumn], table_comment: Optional[str] = None
+) -> str:
+    return make_table_document(
+        table_name,
+        [column.name for column in columns],
+        table_comment,
+        [column.comment for column in columns],
+    )
+
+
+def make_table_document_from_definition(table_name: str, table_def: str) -> str:
+    return make_table_document(table_name, parse_column_names(table_def))
+
+
+class BM25Index:
+    """
+    Okapi BM25 over tokenized table documents, kept in postings so a query
+    only touches the tables that share a token with it.
+    """
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        # token -> {table name: term frequency}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.document_lengths: Dict[str, int] = {}
+        self.document_tokens: Dict[str, List[str]] = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.document_lengths)
+
+    def add_document(self, table_name: str, text: str):
+        """
+        Index a table document, replacing what was indexed for it before.
+        """
+        self.remove_document(table_name)
+
+        term_frequencies = Counter(tokenize(text))
+        for token, frequency in term_frequencies.items():
+            self.postings.setdefault(token, {})[table_name] = frequency
+
+        length = sum(term_frequencies.values())
+        self.document_lengths[table_name] = length
+        self.document_tokens[table_name] = list(term_frequencies)
+        self.total_length += length
+
+    def add_documents(self, map_table_name_to_document: Dict[str, str]):
+        for table_name, text in map_table_name_to_document.items():
+            self.add_document(table_name, text)
+
+    def remove_document(self, table_name: str):
+        tokens = self.document_tokens.pop(table_name, None)
+        if tokens is None:
+            return
+
+        for token in tokens:
+            del self.postings[token][table_name]
+            if not self.postings[token]:
+                del self.postings[token]
+        self.total_length -= self.document_lengths.pop(table_name)
+
+    def get_scores(self, query: str) -> Dict[str, float]:
+        """
+        BM25 score of every table sharing at least one token with the query.
+        """
+        scores: Dict[str, float] = {}
+        if not self.document_lengths:
+            return scores
+
+        n_documents = len(self.document_lengths)
+        average_length = self.total_length / n_documents or 1
+
+        for token in set(tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+
+            idf = math.log(
+                1 + (n_documents - len(postings) + 0.5) / (len(postings) + 0.5)
+            )
+            for table_name, frequency in postings.items():
+                length_norm = (
+                    1
+                    - self.b
+                    + self.b * (self.document_lengths[table_name] / average_length)
+                )
+                scores[table_name] = scores.get(table_name, 0.0) + idf * (
+                    frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+                )
+
+        return scores
+
+    def rank(
+        self,
+        query: str,
+        n: int,
+        min_relative_score: float = RETRIEVAL_MIN_RELATIVE_SCORE,
+    ) -> List[str]:
+        """
+        Top n tables for the query, best first, dropping those scoring below
+        min_relative_score of the best one. Tables without a single matching token are never returned.
+        """
+        scores = self.get_scores(query)
+        if not scores:
+            return []
+
+        min_score = max(scores.values()) * min_relative_score
+        ranked = sorted(
+            (table_name for table_name, score in scores.items() if score >= min_score),
+            key=lambda table_name: (-scores[table_name], table_name),
+        )
+        return ranked[:n]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[str]], k: int = RRF_K
+) -> List[Tuple[str, float]]:
+    """
+    Fuse rankings (best first) into one de-duplicated ranking of (table name, fused score).
+
+    Every list adds 1 / (k + rank) to each table it contains, so tables ranked
+    high by several retrievers rise to the top without their raw scores having
+    to be comparable.
+    """
+    fused: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, table_name in enumerate(ranking, start=1):
+            fused[table_name] = fused.get(table_name, 0.0) + 1 / (k + rank)
+
+    return sorted(fused.items(), key=lambda item: (-item[1], item[0]))
+
+
+def cut_off(fused: List[Tuple[str, float]], n: int) -> List[str]:
+    """
+    The top n table names of a fused ranking.
+    """
+    return [table_name for table_name, _ in fused[:n]]
@@ -0,0 +1,128 @@
+"""
+Purpose:
+    Cache database schema snapshots in-process and on local disk.
+    A snapshot is only reused while its catalog fingerprint matches the live database,
+    so the catalog is re-read only after DDL has actually happened.
+"""
+
+from dataclasses import asdict
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+from modules.fk_graph import ForeignKeyGraph
+from modules.models import ForeignKey, SchemaSnapshot, TableColumn
+
+CACHE_DIR = os.environ.get("CACHE_DIR", "./.cache")
+
+# bump whenever the snapshot file layout changes - files of another version are ignored
+SNAPSHOT_FORMAT_VERSION = 1
+
+# map of database identity to its latest snapshot
+_snapshots: Dict[str, SchemaSnapshot] = {}
+# map of database identity to the foreign key graph of its latest snapshot
+_foreign_key_graphs: Dict[str, ForeignKeyGraph] = {}
+_lock = threading.Lock()
+
+
+def get_snapshot(identity: str, fingerprint: str) -> Optional[SchemaSnapshot]:
+    """
+    Get the cached snapshot for a database if it is still fresh.
+    Checks memory first, then disk.
+    """
+    with _lock:
+        snapshot = _snapshots.get(identity)
+
+    if snapshot is not None and snapshot.fingerprint == fingerprint:
+        return snapshot
+
+    snapshot = read_snapshot_file(identity)
+
+    if snapshot is None or snapshot.fingerprint != fingerprint:
+        return None
+
+    with _lock:
+        _snapshots[identity] = snapshot
+
+    return snapshot
+
+
+def put_snapshot(identity: str, snapshot: SchemaSnapshot):
+    """
+    Store a snapshot in memory and on disk.
+    """
+    with _lock:
+        _snapshots[identity] = snapshot
+
+    write_snapshot_file(identity, snapshot)
+
+
+def get_foreign_key_graph(identity: str, snapshot: SchemaSnapshot) -> ForeignKeyGraph:
+    """
+    Get the foreign key graph of a snapshot, building it only when the snapshot changed.
+    """
+    with _lock:
+        graph = _foreign_key_graphs.get(identity)
+
+    if graph is not None and graph.fingerprint == snapshot.fingerprint:
+        return graph
+
+    graph = ForeignKeyGraph(snapshot.foreign_keys, snapshot.fingerprint)
+
+    with _lock:
+        _foreign_key_graphs[identity] = graph
+
+    return graph
+
+
+def clear():
+    """
+    Drop every in-process snapshot and graph. Disk snapshots are left alone.
+    """
+    with _lock:
+        _snapshots.clear()
+        _foreign_key_graphs.clear()
+
+
+def snapshot_file(identity: str):
+    return os.path.join(CACHE_DIR, "schema", f"{identity}.json")
+
+
+def read_snapshot_file(identity: str) -> Optional[SchemaSnapshot]:
+    fname = snapshot_file(identity)
+
+    # a file from an older layout, or a damaged one, is just a cache miss
+    try:
+        with open(fname, "r") as f:
+            data = json.load(f)
+
+        if data.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            return None
+
+        return SchemaSnapshot(
+            fingerprint=data["fingerprint"],
+            table_columns={
+                table_name: [TableColumn(**column) for column in columns]
+                for table_name, columns in data["table_columns"].items()
+            },
+            table_definitions=data["table_definitions"],
+            table_comments=data.get("table_comments", {}),
+            foreign_keys=[
+                ForeignKey(**foreign_key)
+                for foreign_key in data.get("foreign_keys", [])
+            ],
+        )
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def write_snapshot_file(identity: str, snapshot: SchemaSnapshot):
+    fname = snapshot_file(identity)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+    # write to a temp file first so concurrent readers never see a partial snapshot
+    tmp_fname = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump({"format_version": SNAPSHOT_FORMAT_VERSION, **asdict(snapshot)}, f)
+    os.replace(tmp_fname, fname)
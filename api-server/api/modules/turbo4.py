@@ -2,7 +2,11 @@
 Clone of postgres_da_ai_agent/agents/turbo4.py
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import inspect
 import json
+import mmap
 import os
 import openai
 import time
@@ -12,13 +16,62 @@ from dataclasses import dataclass, asdict
 from openai import OpenAI
 from openai.types.beta import Thread, Assistant
 from openai.types import FileObject
-from openai.types.beta.threads.thread_message import ThreadMessage
+from openai.types.beta.threads import Message
 from openai.types.beta.threads.run_submit_tool_outputs_params import ToolOutput
-from modules import llm
-from modules.models import Chat, TurboTool
+from modules import id_registry, llm, usage
+from modules.models import Chat, TurboTool, UsageTotals
 
 dotenv.load_dotenv()
 
+# set TURBO4_STREAMING=0 to always poll runs
+TURBO4_STREAMING = os.environ.get("TURBO4_STREAMING", "1") != "0"
+TURBO4_MIN_POLLING_INTERVAL = float(os.environ.get("TURBO4_MIN_POLLING_INTERVAL", 0.1))
+TURBO4_MAX_POLLING_INTERVAL = float(os.environ.get("TURBO4_MAX_POLLING_INTERVAL", 2.0))
+
+# files upsert_files uploads at the same time
+TURBO4_UPLOAD_MAX_WORKERS = int(os.environ.get("TURBO4_UPLOAD_MAX_WORKERS", 4))
+
+# messages fetched per page by load_threads
+TURBO4_MESSAGES_PAGE_SIZE = 100
+
+# a run in one of these states will never complete
+RUN_FAILED_STATUSES = ("failed", "cancelled", "cancelling", "expired")
+
+
+def supports_streaming(client) -> bool:
+    """
+    Run streaming arrived in openai 1.14 - older clients can only poll.
+    """
+    try:
+        parameters = inspect.signature(client.beta.threads.runs.create).parameters
+    except (TypeError, ValueError):
+        return False
+    return "stream" in parameters
+
+
+def file_content_hash(file_path: str) -> str:
+    """
+    SHA-256 of a file, hashed through a memory map instead of reading it into memory.
+    """
+    content_hash = hashlib.sha256()
+    # empty files can't be memory mapped
+    if os.path.getsize(file_path) == 0:
+        return content_hash.hexdigest()
+
+    with open(file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            content_hash.update(mapped)
+    return content_hash.hexdigest()
+
+
+def is_run_event(event) -> bool:
+    """
+    thread.run.* lifecycle events, which carry the run - not thread.message.* or thread.run.step.*
+    """
+    return event.event.startswith("thread.run.") and not event.event.startswith(
+        "thread.run.step."
+    )
+
 
 class Turbo4:
     """
@@ -31,26 +84,37 @@ class Turbo4:
 
         self.map_function_tools: Dict[str, TurboTool] = {}
         self.current_thread_id = None
-        self.thread_messages: List[ThreadMessage] = []
+        # messages of the current thread oldest first, with their chats converted once
+        self.thread_messages: List[Message] = []
+        self.thread_chats: List[Chat] = []
+        # cursor for load_threads - only messages after it are fetched
+        self.last_message_id: Optional[str] = None
         self.local_messages = []
         self.file_ids = []
         self.assistant_id = None
-        self.polling_interval = (
-            0.5  # Interval in seconds to poll the API for thread run completion
-        )
+        # assistant, thread and file ids by name - skips the list endpoints on a hit
+        self.registry = id_registry.get_registry(openai.api_key)
+        # stream run events when the installed openai client supports it, poll otherwise
+        self.streaming = TURBO4_STREAMING and supports_streaming(self.client)
+        # polling backs off exponentially between these intervals (seconds)
+        self.min_polling_interval = TURBO4_MIN_POLLING_INTERVAL
+        self.max_polling_interval = TURBO4_MAX_POLLING_INTERVAL
         self.model = "gpt-4-1106-preview"
+        # token usage reported by the runs of this assistant
+        self.usage = UsageTotals()
 
     @property
     def chat_messages(self) -> List[Chat]:
-        return [
-            Chat(
-                from_name=msg.role,
-                to_name="assistant" if msg.role == "user" else "user",
-                message=llm.safe_get(msg.model_dump(), "content.0.text.value"),
-                created=msg.created_at,
-            )
-            for msg in self.thread_messages
-        ]
+        return list(self.thread_chats)
+
+    @staticmethod
+    def message_as_chat(msg: Message) -> Chat:
+        return Chat(
+            from_name=msg.role,
+            to_name="assistant" if msg.role == "user" else "user",
+            message=llm.safe_get(msg.model_dump(), "content.0.text.value"),
+            created=msg.created_at,
+        )
 
     @property
     def tool_config(self):
@@ -75,29 +139,21 @@ class Turbo4:
 
     def get_costs_and_tokens(self, output_file: str) -> Tuple[float, float]:
         """
-        Get the estimated cost and token usage for the current thread.
+        Get the cost and token usage of the runs made by this assistant,
+        from the usage the API reported for each run.
 
         https://openai.com/pricing
 
         Open questions - how to calculate retrieval and code interpreter costs?
         """
 
-        retrival_costs = 0
-        code_interpreter_costs = 0
-
-        msgs = [
-            llm.safe_get(msg.model_dump(), "content.0.text.value")
-            for msg in self.thread_messages
-        ]
-        joined_msgs = " ".join(msgs)
-
-        msg_cost, tokens = llm.estimate_price_and_tokens(joined_msgs, self.model)
-
         with open(output_file, "w") as f:
             json.dump(
                 {
-                    "cost": msg_cost,
-                    "tokens": tokens,
+                    "cost": self.usage.cost,
+                    "tokens": self.usage.total_tokens,
+                    "prompt_tokens": self.usage.prompt_tokens,
+                    "completion_tokens": self.usage.completion_tokens,
                 },
                 f,
                 indent=2,
@@ -105,10 +161,78 @@ class Turbo4:
 
         return self
 
+    def record_run_usage(self, run):
+        """
+        Add the usage of a finished run to this assistant's totals and the usage ledger.
+        """
+        run_usage = getattr(run, "usage", None)
+        if run_usage is not None:
+            prompt_tokens = run_usage.prompt_tokens
+            completion_tokens = run_usage.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = self.estimate_run_tokens(run)
+
+        cost = usage.ledger.record(
+            run.model or self.model, prompt_tokens, completion_tokens
+        )
+
+        self.usage.prompt_tokens += prompt_tokens
+        self.usage.completion_tokens += completion_tokens
+        self.usage.cost += cost
+        self.usage.calls += 1
+
+    def estimate_run_tokens(self, run) -> Tuple[int, int]:
+        """
+        Estimate the (prompt, completion) tokens of a run that reported no usage
+        from the thread's messages - the ones the run wrote are its completion.
+        Tool calls and retrieved file content aren't counted.
+        """
+        self.load_threads()
+
+        prompt_tokens = 0
+        completion_tokens = 0
+        for msg, chat in zip(self.thread_messages, self.thread_chats):
+            tokens = llm.count_tokens(chat.message or "")
+            if msg.run_id == run.id:
+                completion_tokens += tokens
+            elif msg.created_at <= run.created_at:
+                prompt_tokens += tokens
+
+        return prompt_tokens, completion_tokens
+
+    def retrieve_registered(self, kind: str, name: str, retrieve: Callable[[str], Any]):
+        """
+        The object registered under a name, fetched by id. None if there's no fresh entry,
+        or if the object was deleted outside this process - then its entry is dropped too.
+        """
+        entry = self.registry.get(kind, name)
+        if entry is None:
+            return None
+
+        try:
+            return retrieve(entry["id"])
+        except openai.NotFoundError:
+            print(f"Registered {kind} {name} ({entry['id']}) no longer exists")
+            self.registry.delete(kind, name)
+            return None
+
     # ------------- CORE ASSISTANTS API FUNCTIONS -----------------
 
     def get_or_create_assistant(self, name: str, model: str = "gpt-4-1106-preview"):
         print(f"get_or_create_assistant({name}, {model})")
+
+        assistant = self.retrieve_registered(
+            "assistant",
+            name,
+            lambda assistant_id: self.client.beta.assistants.retrieve(
+                assistant_id=assistant_id
+            ),
+        )
+        if assistant is not None and assistant.model == model:
+            self.assistant_id = assistant.id
+            self.model = model
+            return self
+
         # Retrieve the list of existing assistants
         assistants: List[Assistant] = self.client.beta.assistants.list().data
 
@@ -129,6 +253,7 @@ class Turbo4:
             self.assistant_id = assistant.id
 
         self.model = model
+        self.registry.put("assistant", name, self.assistant_id, model=model)
 
         return self
 
@@ -164,17 +289,39 @@ class Turbo4:
 
         return self
 
-    def make_thread(self):
-        print(f"make_thread()")
+    def make_thread(self, thread_name: Optional[str] = None):
+        """
+        Start a new thread. A named thread is reused while its registry entry is fresh
+        and the thread still exists.
+        """
+        print(f"make_thread({thread_name})")
 
         if self.assistant_id is None:
             raise ValueError(
                 "No assistant has been created. Call create_assistant() first."
             )
 
-        response = self.client.beta.threads.create()
-        self.current_thread_id = response.id
+        thread = None
+        if thread_name is not None:
+            thread = self.retrieve_registered(
+                "thread",
+                thread_name,
+                lambda thread_id: self.client.beta.threads.retrieve(
+                    thread_id=thread_id
+                ),
+            )
+
+        if thread is not None:
+            self.current_thread_id = thread.id
+        else:
+            response = self.client.beta.threads.create()
+            self.current_thread_id = response.id
+            if thread_name is not None:
+                self.registry.put("thread", thread_name, self.current_thread_id)
+
         self.thread_messages = []
+        self.thread_chats = []
+        self.last_message_id = None
         return self
 
     def add_message(
@@ -196,9 +343,27 @@ class Turbo4:
         return self
 
     def load_threads(self):
-        self.thread_messages = self.client.beta.threads.messages.list(
-            thread_id=self.current_thread_id
-        ).data
+        """
+        Fetch the messages added to the thread since the last load, oldest first,
+        and convert only those - the cost of a step doesn't grow with the thread.
+        """
+        while True:
+            params = {"order": "asc", "limit": TURBO4_MESSAGES_PAGE_SIZE}
+            if self.last_message_id is not None:
+                params["after"] = self.last_message_id
+
+            new_messages: List[Message] = self.client.beta.threads.messages.list(
+                thread_id=self.current_thread_id, **params
+            ).data
+            if not new_messages:
+                return
+
+            self.thread_messages.extend(new_messages)
+            self.thread_chats.extend(self.message_as_chat(msg) for msg in new_messages)
+            self.last_message_id = new_messages[-1].id
+
+            if len(new_messages) < TURBO4_MESSAGES_PAGE_SIZE:
+                return
 
     def list_steps(self):
         print(f"list_steps()")
@@ -231,58 +396,133 @@ class Turbo4:
         # refresh current thread
         self.load_threads()
 
-        # Start the thread running
-        run = self.client.beta.threads.runs.create(
+        if self.streaming:
+            self.stream_run(tools)
+        else:
+            run = self.client.beta.threads.runs.create(
+                thread_id=self.current_thread_id,
+                assistant_id=self.assistant_id,
+                tools=tools,
+            )
+            self.run_id = run.id
+            self.poll_run()
+
+        self.load_threads()
+        return self
+
+    def stream_run(self, tools: Optional[List[Dict[str, Any]]] = None):
+        """
+        Start a run and consume its events as they arrive.
+        Tool calls are dispatched as soon as requires_action fires, and submitting
+        their outputs continues the run on a new event stream.
+        Falls back to polling if a stream ends before the run does.
+        """
+        self.run_id = None
+        stream = self.client.beta.threads.runs.create(
             thread_id=self.current_thread_id,
             assistant_id=self.assistant_id,
             tools=tools,
+            stream=True,
         )
-        self.run_id = run.id
 
-        # Polling mechanism to wait for thread's run completion or required actions
-        while True:
-            # self.list_steps()
+        while stream is not None:
+            next_stream = None
+
+            try:
+                for event in stream:
+                    if not is_run_event(event):
+                        continue
+
+                    run = event.data
+                    self.run_id = run.id
+
+                    if run.status == "requires_action":
+                        next_stream = self.client.beta.threads.runs.submit_tool_outputs(
+                            thread_id=self.current_thread_id,
+                            run_id=self.run_id,
+                            tool_outputs=self.call_tools(run),
+                            stream=True,
+                        )
+                        break
+                    elif run.status == "completed":
+                        self.record_run_usage(run)
+                        return
+                    elif run.status in RUN_FAILED_STATUSES:
+                        raise RuntimeError(
+                            f"Run {run.id} {run.status}: {run.last_error}"
+                        )
+            finally:
+                stream.response.close()
+
+            stream = next_stream
+
+        if self.run_id is None:
+            raise RuntimeError("Run stream ended before the run was created.")
 
-            run_status = self.client.beta.threads.runs.retrieve(
+        print(f"stream_run() stream ended early, polling run {self.run_id}")
+        self.poll_run()
+
+    def poll_run(self):
+        """
+        Poll the current run until it completes, calling tools whenever it requires action.
+        The interval starts at min_polling_interval and doubles up to max_polling_interval
+        while the run is busy, so short runs return quickly and long ones cost few requests.
+        """
+        polling_interval = self.min_polling_interval
+
+        while True:
+            run = self.client.beta.threads.runs.retrieve(
                 thread_id=self.current_thread_id, run_id=self.run_id
             )
-            if run_status.status == "requires_action":
-                tool_outputs: List[ToolOutput] = []
-                for (
-                    tool_call
-                ) in run_status.required_action.submit_tool_outputs.tool_calls:
-                    tool_function = tool_call.function
-                    tool_name = tool_function.name
-
-                    # Check if tool_arguments is already a dictionary, if so, proceed directly
-                    if isinstance(tool_function.arguments, dict):
-                        tool_arguments = tool_function.arguments
-                    else:
-                        # Assume the arguments are JSON string and parse them
-                        tool_arguments = json.loads(tool_function.arguments)
-
-                    print(f"run_thread() Calling {tool_name}({tool_arguments})")
-
-                    # Assuming arguments are passed as a dictionary
-                    function_output = self.map_function_tools[tool_name].function(
-                        **tool_arguments
-                    )
-
-                    tool_outputs.append(
-                        ToolOutput(tool_call_id=tool_call.id, output=function_output)
-                    )
 
+            if run.status == "requires_action":
                 # Submit the tool outputs back to the API
                 self.client.beta.threads.runs.submit_tool_outputs(
                     thread_id=self.current_thread_id,
                     run_id=self.run_id,
-                    tool_outputs=[to for to in tool_outputs],
+                    tool_outputs=self.call_tools(run),
                 )
-            elif run_status.status == "completed":
-                self.load_threads()
-                return self
+                polling_interval = self.min_polling_interval
+                continue
+            elif run.status == "completed":
+                self.record_run_usage(run)
+                return
+            elif run.status in RUN_FAILED_STATUSES:
+                raise RuntimeError(f"Run {run.id} {run.status}: {run.last_error}")
+
+            time.sleep(polling_interval)  # Wait a little before polling again
+            polling_interval = min(polling_interval * 2, self.max_polling_interval)
+
+    def call_tools(self, run) -> List[ToolOutput]:
+        """
+        Call the tools a run requires and collect their outputs.
+        The calls of one step run concurrently, outputs stay in call order.
+        """
+        tool_calls = run.required_action.submit_tool_outputs.tool_calls
+
+        calls = []
+        for tool_call in tool_calls:
+            tool_function = tool_call.function
+            tool_name = tool_function.name
+
+            # Check if tool_arguments is already a dictionary, if so, proceed directly
+            if isinstance(tool_function.arguments, dict):
+                tool_arguments = tool_function.arguments
+            else:
+                # Assume the arguments are JSON string and parse them
+                tool_arguments = json.loads(tool_function.arguments)
+
+            print(f"run_thread() Calling {tool_name}({tool_arguments})")
+
+            # Assuming arguments are passed as a dictionary
+            calls.append((self.map_function_tools[tool_name].function, tool_arguments))
 
-            time.sleep(self.polling_interval)  # Wait a little before polling again
+        function_outputs = llm.run_tool_calls(calls)
+
+        return [
+            ToolOutput(tool_call_id=tool_call.id, output=function_output)
+            for tool_call, function_output in zip(tool_calls, function_outputs)
+        ]
 
     def enable_retrieval(self):
         print(f"enable_retrieval()")
@@ -303,10 +543,12 @@ class Turbo4:
 
         Upserts files to the file api - does not attach to assistant at all
 
-        1. Get all current files from the files api
-        2. Check if file exists
-        3. If file exists, look for byte size differences if changed: update it
-        4. If file does not exist, create it
+        1. Hash every file's content
+        2. Look up the files by name - in the registry, or the files api on a miss
+        3. Keep files whose registered content hash matches
+        4. Upload every other file concurrently, then delete the versions they replace
+
+        Returns the file ids in the order of file_paths.
         """
         print(f"upsert_file({file_paths})")
 
@@ -320,77 +562,156 @@ class Turbo4:
                 "No assistant has been created or retrieved. Call get_or_create_assistant() first."
             )
 
-        existing_files: List[FileObject] = self.client.files.list().data
+        file_names = [os.path.basename(file_path) for file_path in file_paths]
+        content_hashes = [file_content_hash(file_path) for file_path in file_paths]
+
+        map_name_to_existing_file = {
+            file.filename: file for file in self.get_files_by_name(file_names)
+        }
+
+        file_ids: List[Optional[str]] = []
+        # (position in file_paths, existing file it replaces)
+        uploads: List[Tuple[int, Optional[FileObject]]] = []
+
+        for index, (file_name, content_hash) in enumerate(
+            zip(file_names, content_hashes)
+        ):
+            existing_file = map_name_to_existing_file.get(file_name)
+            entry = self.registry.get("file", file_name)
+
+            if (
+                existing_file is not None
+                and entry is not None
+                and entry["id"] == existing_file.id
+                and entry.get("hash") == content_hash
+            ):
+                print(f"File {file_name} is unchanged - no upload needed")
+                file_ids.append(existing_file.id)
+                continue
+
+            print(f"File {file_name} is new or has changed - uploading")
+            file_ids.append(None)
+            uploads.append((index, existing_file))
+
+        if not uploads:
+            return file_ids
+
+        with ThreadPoolExecutor(
+            max_workers=min(TURBO4_UPLOAD_MAX_WORKERS, len(uploads))
+        ) as executor:
+            uploaded_files = list(
+                executor.map(
+                    lambda upload: self.upload_file(file_paths[upload[0]], upload[1]),
+                    uploads,
+                )
+            )
 
-        print("existing_files", existing_files)
+        for (index, _), uploaded_file in zip(uploads, uploaded_files):
+            file_ids[index] = uploaded_file.id
 
-        matched_files: List[FileObject] = []
+        self.register_files(
+            uploaded_files,
+            {file_names[index]: content_hashes[index] for index, _ in uploads},
+        )
 
-        # create file objects
-        for i in file_paths:
-            file_name = os.path.basename(i)
-            file_object = open(i, "rb")
+        return file_ids
 
-            print("file_object", file_object)
+    def upload_file(
+        self, file_path: str, replaced_file: Optional[FileObject] = None
+    ) -> FileObject:
+        """
+        Upload a file, then delete the file it replaces so there's always one version available.
+        """
+        with open(file_path, "rb") as f:
+            uploaded_file: FileObject = self.client.files.create(
+                file=f,
+                purpose="assistants",
+            )
 
-            local_file_size = os.path.getsize(i)
+        if replaced_file is not None:
+            try:
+                self.client.files.delete(file_id=replaced_file.id)
+            except openai.NotFoundError:
+                # a concurrent upsert of the same file already replaced it
+                pass
+
+        return uploaded_file
+
+    def register_files(
+        self,
+        files: List[FileObject],
+        map_name_to_hash: Optional[Dict[str, str]] = None,
+    ):
+        """
+        Remember files by name. The list endpoint returns the newest first, so the newest wins.
 
-            file_found = False  # Flag to check if file was found
+        map_name_to_hash has the content hashes of files just uploaded. Other files keep the
+        hash registered for them, as long as it was registered for the same file id.
+        """
+        map_name_to_hash = map_name_to_hash or {}
 
-            # check if file exists
-            for existing_file in existing_files:
-                if existing_file.filename == file_name:
-                    print(f"Found existing file {file_name}")
-                    file_found = True  # Set flag to True since file is found
+        map_name_to_entry = {}
+        for file in reversed(files):
+            content_hash = map_name_to_hash.get(file.filename)
+            if content_hash is None:
+                entry = self.registry.get("file", file.filename, fresh_only=False)
+                if entry is not None and entry["id"] == file.id:
+                    content_hash = entry.get("hash")
 
-                    # check if file has changed - delete and reupload if so
-                    if existing_file.bytes != local_file_size:
-                        print(f"File {file_name} has changed - updating")
-                        self.client.files.delete(file_id=existing_file)
-                        updated_file_object: FileObject = self.client.files.create(
-                            file=file_object,
-                            purpose="assistants",
-                        )
-                        matched_files.append(updated_file_object)
-                    break  # Exit the loop after handling the existing file
-
-            # If the file was not found, create it
-            if not file_found:
-                print(f"Creating file {file_name}")
-                new_file_object: FileObject = self.client.files.create(
-                    file=file_object,
-                    purpose="assistants",
-                )
-                matched_files.append(new_file_object)
-            else:
-                print(f"File {file_name} already exists - no updates needed")
-                matched_files.append(existing_file)
+            map_name_to_entry[file.filename] = {
+                "id": file.id,
+                "bytes": file.bytes,
+                "hash": content_hash,
+            }
 
-        return [f.id for f in matched_files]
+        self.registry.put_many("file", map_name_to_entry)
 
     def get_files(self, file_ids: Optional[List[str]] = None):
         print(f"list_files()")
         files = self.client.files.list().data
+        self.register_files(files)
         if file_ids is not None:
             print(f"filtering files by {file_ids}")
+            file_ids = set(file_ids)
             files = [file for file in files if file.id in file_ids]
         print("files", files)
         return files
 
     def get_files_by_name(self, file_names: List[str]):
+        """
+        Files by name from the registry, listing the files api only for names it doesn't know.
+        Names without a file are left out.
+        """
         print(f"get_files_by_name({file_names})")
-        files: List[FileObject] = self.client.files.list().data
-
-        output_files = []
 
+        map_name_to_file: Dict[str, FileObject] = {}
         for file_name in file_names:
+            # a registered file deleted outside this process is looked up again below
+            file = self.retrieve_registered(
+                "file",
+                file_name,
+                lambda file_id: self.client.files.retrieve(file_id=file_id),
+            )
+            if file is not None:
+                map_name_to_file[file_name] = file
+
+        missing_file_names = set(file_names) - set(map_name_to_file)
+        if missing_file_names:
+            files: List[FileObject] = self.client.files.list().data
+            self.register_files(files)
+
+            # newest first, keep the first file seen per name
             for file in files:
-                print("file.filename", file.filename)
-                if file.filename == file_name:
-                    output_files.append(file)
-                    break
+                if file.filename in missing_file_names:
+                    map_name_to_file.setdefault(file.filename, file)
 
-        print("files", files)
+        output_files = [
+            map_name_to_file[file_name]
+            for file_name in file_names
+            if file_name in map_name_to_file
+        ]
+
+        print("files", output_files)
 
         return output_files
 
@@ -1,3 +1,4 @@
+import inspect
 import json
 import os
 import openai
@@ -7,13 +8,44 @@ import dotenv
 from dataclasses import dataclass, asdict
 from openai.types.beta import Thread, Assistant
 from openai.types import FileObject
-from openai.types.beta.threads.thread_message import ThreadMessage
+from openai.types.beta.threads import Message
 from openai.types.beta.threads.run_submit_tool_outputs_params import ToolOutput
-from postgres_da_ai_agent.modules import llm
-from postgres_da_ai_agent.types import Chat, TurboTool
+from postgres_da_ai_agent.modules import id_registry, llm, usage
+from postgres_da_ai_agent.types import Chat, TurboTool, UsageTotals
 
 dotenv.load_dotenv()
 
+# set TURBO4_STREAMING=0 to always poll runs
+TURBO4_STREAMING = os.environ.get("TURBO4_STREAMING", "1") != "0"
+TURBO4_MIN_POLLING_INTERVAL = float(os.environ.get("TURBO4_MIN_POLLING_INTERVAL", 0.1))
+TURBO4_MAX_POLLING_INTERVAL = float(os.environ.get("TURBO4_MAX_POLLING_INTERVAL", 2.0))
+
+# messages fetched per page by load_threads
+TURBO4_MESSAGES_PAGE_SIZE = 100
+
+# a run in one of these states will never complete
+RUN_FAILED_STATUSES = ("failed", "cancelled", "cancelling", "expired")
+
+
+def supports_streaming(client) -> bool:
+    """
+    Run streaming arrived in openai 1.14 - older clients can only poll.
+    """
+    try:
+        parameters = inspect.signature(client.beta.threads.runs.create).parameters
+    except (TypeError, ValueError):
+        return False
+    return "stream" in parameters
+
+
+def is_run_event(event) -> bool:
+    """
+    thread.run.* lifecycle events, which carry the run - not thread.message.* or thread.run.step.*
+    """
+    return event.event.startswith("thread.run.") and not event.event.startswith(
+        "thread.run.step."
+    )
+
 
 class Turbo4:
     """
@@ -25,25 +57,36 @@ class Turbo4:
         self.client = openai.OpenAI()
         self.map_function_tools: Dict[str, TurboTool] = {}
         self.current_thread_id = None
-        self.thread_messages: List[ThreadMessage] = []
+        # messages of the current thread oldest first, with their chats converted once
+        self.thread_messages: List[Message] = []
+        self.thread_chats: List[Chat] = []
+        # cursor for load_threads - only messages after it are fetched
+        self.last_message_id: Optional[str] = None
         self.local_messages = []
         self.assistant_id = None
-        self.polling_interval = (
-            0.5  # Interval in seconds to poll the API for thread run completion
-        )
+        # assistant, thread and file ids by name - skips the list endpoints on a hit
+        self.registry = id_registry.get_registry(openai.api_key)
+        # stream run events when the installed openai client supports it, poll otherwise
+        self.streaming = TURBO4_STREAMING and supports_streaming(self.client)
+        # polling backs off exponentially between these intervals (seconds)
+        self.min_polling_interval = TURBO4_MIN_POLLING_INTERVAL
+        self.max_polling_interval = TURBO4_MAX_POLLING_INTERVAL
         self.model = "gpt-4-1106-preview"
+        # token usage reported by the runs of this assistant
+        self.usage = UsageTotals()
 
     @property
     def chat_messages(self) -> List[Chat]:
-        return [
-            Chat(
-                from_name=msg.role,
-                to_name="assistant" if msg.role == "user" else "user",
-                message=llm.safe_get(msg.model_dump(), "content.0.text.value"),
-                created=msg.created_at,
-            )
-            for msg in self.thread_messages
-        ]
+        return list(self.thread_chats)
+
+    @staticmethod
+    def message_as_chat(msg: Message) -> Chat:
+        return Chat(
+            from_name=msg.role,
+            to_name="assistant" if msg.role == "user" else "user",
+            message=llm.safe_get(msg.model_dump(), "content.0.text.value"),
+            created=msg.created_at,
+        )
 
     @property
     def tool_config(self):
@@ -68,29 +111,21 @@ class Turbo4:
 
     def get_costs_and_tokens(self, output_file: str) -> Tuple[float, float]:
         """
-        Get the estimated cost and token usage for the current thread.
+        Get the cost and token usage of the runs made by this assistant,
+        from the usage the API reported for each run.
 
         https://openai.com/pricing
 
         Open questions - how to calculate retrieval and code interpreter costs?
         """
 
-        retrival_costs = 0
-        code_interpreter_costs = 0
-
-        msgs = [
-            llm.safe_get(msg.model_dump(), "content.0.text.value")
-            for msg in self.thread_messages
-        ]
-        joined_msgs = " ".join(msgs)
-
-        msg_cost, tokens = llm.estimate_price_and_tokens(joined_msgs)
-
         with open(output_file, "w") as f:
             json.dump(
                 {
-                    "cost": msg_cost,
-                    "tokens": tokens,
+                    "cost": self.usage.cost,
+                    "tokens": self.usage.total_tokens,
+                    "prompt_tokens": self.usage.prompt_tokens,
+                    "completion_tokens": self.usage.completion_tokens,
                 },
                 f,
                 indent=2,
@@ -98,10 +133,78 @@ class Turbo4:
 
         return self
 
+    def record_run_usage(self, run):
+        """
+        Add the usage of a finished run to this assistant's totals and the usage ledger.
+        """
+        run_usage = getattr(run, "usage", None)
+        if run_usage is not None:
+            prompt_tokens = run_usage.prompt_tokens
+            completion_tokens = run_usage.completion_tokens
+        else:
+            prompt_tokens, completion_tokens = self.estimate_run_tokens(run)
+
+        cost = usage.ledger.record(
+            run.model or self.model, prompt_tokens, completion_tokens
+        )
+
+        self.usage.prompt_tokens += prompt_tokens
+        self.usage.completion_tokens += completion_tokens
+        self.usage.cost += cost
+        self.usage.calls += 1
+
+    def estimate_run_tokens(self, run) -> Tuple[int, int]:
+        """
+        Estimate the (prompt, completion) tokens of a run that reported no usage
+        from the thread's messages - the ones the run wrote are its completion.
+        Tool calls and retrieved file content aren't counted.
+        """
+        self.load_threads()
+
+        prompt_tokens = 0
+        completion_tokens = 0
+        for msg, chat in zip(self.thread_messages, self.thread_chats):
+            tokens = llm.count_tokens(chat.message or "")
+            if msg.run_id == run.id:
+                completion_tokens += tokens
+            elif msg.created_at <= run.created_at:
+                prompt_tokens += tokens
+
+        return prompt_tokens, completion_tokens
+
+    def retrieve_registered(self, kind: str, name: str, retrieve: Callable[[str], Any]):
+        """
+        The object registered under a name, fetched by id. None if there's no fresh entry,
+        or if the object was deleted outside this process - then its entry is dropped too.
+        """
+        entry = self.registry.get(kind, name)
+        if entry is None:
+            return None
+
+        try:
+            return retrieve(entry["id"])
+        except openai.NotFoundError:
+            print(f"Registered {kind} {name} ({entry['id']}) no longer exists")
+            self.registry.delete(kind, name)
+            return None
+
     # ------------- CORE ASSISTANTS API FUNCTIONS -----------------
 
     def get_or_create_assistant(self, name: str, model: str = "gpt-4-1106-preview"):
         print(f"get_or_create_assistant({name}, {model})")
+
+        assistant = self.retrieve_registered(
+            "assistant",
+            name,
+            lambda assistant_id: self.client.beta.assistants.retrieve(
+                assistant_id=assistant_id
+            ),
+        )
+        if assistant is not None and assistant.model == model:
+            self.assistant_id = assistant.id
+            self.model = model
+            return self
+
         # Retrieve the list of existing assistants
         assistants: List[Assistant] = self.client.beta.assistants.list().data
 
@@ -122,6 +225,7 @@ class Turbo4:
             self.assistant_id = assistant.id
 
         self.model = model
+        self.registry.put("assistant", name, self.assistant_id, model=model)
 
         return self
 
@@ -157,17 +261,39 @@ class Turbo4:
 
         return self
 
-    def make_thread(self):
-        print(f"make_thread()")
+    def make_thread(self, thread_name: Optional[str] = None):
+        """
+        Start a new thread. A named thread is reused while its registry entry is fresh
+        and the thread still exists.
+        """
+        print(f"make_thread({thread_name})")
 
         if self.assistant_id is None:
             raise ValueError(
                 "No assistant has been created. Call create_assistant() first."
             )
 
-        response = self.client.beta.threads.create()
-        self.current_thread_id = response.id
+        thread = None
+        if thread_name is not None:
+            thread = self.retrieve_registered(
+                "thread",
+                thread_name,
+                lambda thread_id: self.client.beta.threads.retrieve(
+                    thread_id=thread_id
+                ),
+            )
+
+        if thread is not None:
+            self.current_thread_id = thread.id
+        else:
+            response = self.client.beta.threads.create()
+            self.current_thread_id = response.id
+            if thread_name is not None:
+                self.registry.put("thread", thread_name, self.current_thread_id)
+
         self.thread_messages = []
+        self.thread_chats = []
+        self.last_message_id = None
         return self
 
     def add_message(self, message: str, refresh_threads: bool = False):
@@ -181,9 +307,27 @@ class Turbo4:
         return self
 
     def load_threads(self):
-        self.thread_messages = self.client.beta.threads.messages.list(
-            thread_id=self.current_thread_id
-        ).data
+        """
+        Fetch the messages added to the thread since the last load, oldest first,
+        and convert only those - the cost of a step doesn't grow with the thread.
+        """
+        while True:
+            params = {"order": "asc", "limit": TURBO4_MESSAGES_PAGE_SIZE}
+            if self.last_message_id is not None:
+                params["after"] = self.last_message_id
+
+            new_messages: List[Message] = self.client.beta.threads.messages.list(
+                thread_id=self.current_thread_id, **params
+            ).data
+            if not new_messages:
+                return
+
+            self.thread_messages.extend(new_messages)
+            self.thread_chats.extend(self.message_as_chat(msg) for msg in new_messages)
+            self.last_message_id = new_messages[-1].id
+
+            if len(new_messages) < TURBO4_MESSAGES_PAGE_SIZE:
+                return
 
     def list_steps(self):
         print(f"list_steps()")
@@ -216,58 +360,133 @@ class Turbo4:
         # refresh current thread
         self.load_threads()
 
-        # Start the thread running
-        run = self.client.beta.threads.runs.create(
+        if self.streaming:
+            self.stream_run(tools)
+        else:
+            run = self.client.beta.threads.runs.create(
+                thread_id=self.current_thread_id,
+                assistant_id=self.assistant_id,
+                tools=tools,
+            )
+            self.run_id = run.id
+            self.poll_run()
+
+        self.load_threads()
+        return self
+
+    def stream_run(self, tools: Optional[List[Dict[str, Any]]] = None):
+        """
+        Start a run and consume its events as they arrive.
+        Tool calls are dispatched as soon as requires_action fires, and submitting
+        their outputs continues the run on a new event stream.
+        Falls back to polling if a stream ends before the run does.
+        """
+        self.run_id = None
+        stream = self.client.beta.threads.runs.create(
             thread_id=self.current_thread_id,
             assistant_id=self.assistant_id,
             tools=tools,
+            stream=True,
         )
-        self.run_id = run.id
 
-        # Polling mechanism to wait for thread's run completion or required actions
-        while True:
-            # self.list_steps()
+        while stream is not None:
+            next_stream = None
+
+            try:
+                for event in stream:
+                    if not is_run_event(event):
+                        continue
+
+                    run = event.data
+                    self.run_id = run.id
+
+                    if run.status == "requires_action":
+                        next_stream = self.client.beta.threads.runs.submit_tool_outputs(
+                            thread_id=self.current_thread_id,
+                            run_id=self.run_id,
+                            tool_outputs=self.call_tools(run),
+                            stream=True,
+                        )
+                        break
+                    elif run.status == "completed":
+                        self.record_run_usage(run)
+                        return
+                    elif run.status in RUN_FAILED_STATUSES:
+                        raise RuntimeError(
+                            f"Run {run.id} {run.status}: {run.last_error}"
+                        )
+            finally:
+                stream.response.close()
+
+            stream = next_stream
+
+        if self.run_id is None:
+            raise RuntimeError("Run stream ended before the run was created.")
+
+        print(f"stream_run() stream ended early, polling run {self.run_id}")
+        self.poll_run()
+
+    def poll_run(self):
+        """
+        Poll the current run until it completes, calling tools whenever it requires action.
+        The interval starts at min_polling_interval and doubles up to max_polling_interval
+        while the run is busy, so short runs return quickly and long ones cost few requests.
+        """
+        polling_interval = self.min_polling_interval
 
-            run_status = self.client.beta.threads.runs.retrieve(
+        while True:
+            run = self.client.beta.threads.runs.retrieve(
                 thread_id=self.current_thread_id, run_id=self.run_id
             )
-            if run_status.status == "requires_action":
-                tool_outputs: List[ToolOutput] = []
-                for (
-                    tool_call
-                ) in run_status.required_action.submit_tool_outputs.tool_calls:
-                    tool_function = tool_call.function
-                    tool_name = tool_function.name
-
-                    # Check if tool_arguments is already a dictionary, if so, proceed directly
-                    if isinstance(tool_function.arguments, dict):
-                        tool_arguments = tool_function.arguments
-                    else:
-                        # Assume the arguments are JSON string and parse them
-                        tool_arguments = json.loads(tool_function.arguments)
-
-                    print(f"run_thread() Calling {tool_name}({tool_arguments})")
-
-                    # Assuming arguments are passed as a dictionary
-                    function_output = self.map_function_tools[tool_name].function(
-                        **tool_arguments
-                    )
-
-                    tool_outputs.append(
-                        ToolOutput(tool_call_id=tool_call.id, output=function_output)
-                    )
 
+            if run.status == "requires_action":
                 # Submit the tool outputs back to the API
                 self.client.beta.threads.runs.submit_tool_outputs(
                     thread_id=self.current_thread_id,
                     run_id=self.run_id,
-                    tool_outputs=[to for to in tool_outputs],
+                    tool_outputs=self.call_tools(run),
                 )
-            elif run_status.status == "completed":
-                self.load_threads()
-                return self
+                polling_interval = self.min_polling_interval
+                continue
+            elif run.status == "completed":
+                self.record_run_usage(run)
+                return
+            elif run.status in RUN_FAILED_STATUSES:
+                raise RuntimeError(f"Run {run.id} {run.status}: {run.last_error}")
+
+            time.sleep(polling_interval)  # Wait a little before polling again
+            polling_interval = min(polling_interval * 2, self.max_polling_interval)
+
+    def call_tools(self, run) -> List[ToolOutput]:
+        """
+        Call the tools a run requires and collect their outputs.
+        The calls of one step run concurrently, outputs stay in call order.
+        """
+        tool_calls = run.required_action.submit_tool_outputs.tool_calls
+
+        calls = []
+        for tool_call in tool_calls:
+            tool_function = tool_call.function
+            tool_name = tool_function.name
+
+            # Check if tool_arguments is already a dictionary, if so, proceed directly
+            if isinstance(tool_function.arguments, dict):
+                tool_arguments = tool_function.arguments
+            else:
+                # Assume the arguments are JSON string and parse them
+                tool_arguments = json.loads(tool_function.arguments)
+
+            print(f"run_thread() Calling {tool_name}({tool_arguments})")
 
-            time.sleep(self.polling_interval)  # Wait a little before polling again
+            # Assuming arguments are passed as a dictionary
+            calls.append((self.map_function_tools[tool_name].function, tool_arguments))
+
+        function_outputs = llm.run_tool_calls(calls)
+
+        return [
+            ToolOutput(tool_call_id=tool_call.id, output=function_output)
+            for tool_call, function_output in zip(tool_calls, function_outputs)
+        ]
 
     def enable_retrieval(self):
         print(f"enable_retrieval()")
@@ -0,0 +1,84 @@
+"""
+Recall and latency of the hnsw table index against the exact matrix search.
+
+Uses the embeddings already cached in the embedding store, topped up with
+synthetic clustered vectors to reach --tables rows.
+
+    python -m postgres_da_ai_agent.ann_benchmark --tables 100000 --queries 200 --k 5
+"""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from postgres_da_ai_agent.modules import embedding_store
+from postgres_da_ai_agent.modules.ann_index import HnswTableIndex
+from postgres_da_ai_agent.modules.embeddings import (
+    get_embedding_model,
+    normalize_rows,
+    top_k_indices,
+)
+
+
+def make_embeddings(n_tables: int, dim: int, seed: int = 0) -> np.ndarray:
+    """
+    Cached table embeddings plus synthetic ones clustered around them.
+    """
+    rng = np.random.default_rng(seed)
+
+    cached = embedding_store.get_embedding_store(get_embedding_model().name).matrix
+    if cached is None or len(cached) == 0 or cached.shape[1] != dim:
+        centers = rng.normal(size=(64, dim)).astype(np.float32)
+    else:
+        centers = np.asarray(cached, dtype=np.float32)
+
+    picks = rng.integers(0, len(centers), n_tables)
+    noise = rng.normal(scale=0.1, size=(n_tables, dim)).astype(np.float32)
+    return normalize_rows(centers[picks] * (1 + noise))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=768)
+    args = parser.parse_args()
+
+    embeddings = make_embeddings(args.tables + args.queries, args.dim)
+    tables, queries = embeddings[: args.tables], embeddings[args.tables :]
+    names = [f"table_{i}" for i in range(args.tables)]
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        index = HnswTableIndex("benchmark", args.dim, cache_dir=cache_dir)
+        index.upsert(names, names, tables)
+        build_seconds = time.perf_counter() - start
+
+        exact_seconds = 0.0
+        ann_seconds = 0.0
+        hits = 0
+
+        for query in queries:
+            start = time.perf_counter()
+            exact = top_k_indices(tables @ query, args.k)
+            exact_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            approximate = index.query(query, args.k)
+            ann_seconds += time.perf_counter() - start
+
+            exact_names = {names[i] for i in exact}
+            hits += len(exact_names.intersection(name for name, _ in approximate))
+
+    print(f"tables: {args.tables}, queries: {args.queries}, k: {args.k}")
+    print(f"hnsw build: {build_seconds:.2f}s")
+    print(f"recall@{args.k}: {hits / (args.queries * args.k):.4f}")
+    print(f"exact latency: {1000 * exact_seconds / args.queries:.3f}ms / query")
+    print(f"hnsw latency: {1000 * ann_seconds / args.queries:.3f}ms / query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Export the BERT embedding model to an int8 quantized ONNX model for the torch-free 'onnx' embedding backend.
+
+Needs torch, transformers, onnx and onnxruntime at export time only.
+
+    python -m postgres_da_ai_agent.export_onnx --output-dir ./models/bert-base-uncased-onnx
+    python -m postgres_da_ai_agent.export_onnx --output-dir ./models/bert-base-uncased-onnx --check
+
+--check compares the onnx embeddings with the BERT path and exits non zero
+if any text's cosine similarity falls below --min-cosine.
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from postgres_da_ai_agent.modules.embeddings import (
+    EMBEDDING_MODEL,
+    EmbeddingModel,
+    normalize_rows,
+)
+from postgres_da_ai_agent.modules.onnx_embeddings import (
+    ONNX_MODEL_FILE,
+    ONNX_TOKENIZER_FILE,
+    OnnxEmbeddingModel,
+)
+
+PARITY_TEXTS = [
+    "CREATE TABLE users (\nid integer,\nemail character varying(255),\ncreated timestamp without time zone\n);",
+    "CREATE TABLE jobs (\nid integer,\nuser_id integer,\nstatus text,\ncost numeric(10,2)\n);",
+    "get jobs with 'Completed' or 'Started' status",
+    "how many users signed up last month?",
+    "average order value per customer by region",
+]
+
+
+def export(output_dir: str, model_name: str = EMBEDDING_MODEL):
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import BertModel, BertTokenizerFast
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    tokenizer = BertTokenizerFast.from_pretrained(model_name)
+    model = BertModel.from_pretrained(model_name)
+    model.eval()
+
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    inputs = tokenizer(PARITY_TEXTS[:2], padding=True, return_tensors="pt")
+
+    fp32_file = os.path.join(output_dir, "model.onnx")
+    print(f"Exporting {model_name} to {fp32_file}")
+    with torch.inference_mode():
+        torch.onnx.export(
+            model,
+            tuple(inputs[name] for name in input_names),
+            fp32_file,
+            input_names=input_names,
+            output_names=["last_hidden_state", "pooler_output"],
+            dynamic_axes={
+                **{name: {0: "batch", 1: "sequence"} for name in input_names},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+                "pooler_output": {0: "batch"},
+            },
+            opset_version=14,
+        )
+
+    int8_file = os.path.join(output_dir, ONNX_MODEL_FILE)
+    print(f"Quantizing weights to int8 in {int8_file}")
+    quantize_dynamic(fp32_file, int8_file, weight_type=QuantType.QInt8)
+
+    tokenizer.backend_tokenizer.save(os.path.join(output_dir, ONNX_TOKENIZER_FILE))
+
+
+def check_parity(output_dir: str, min_cosine: float) -> bool:
+    """
+    Cosine similarity between the BERT and onnx embeddings of the same texts.
+    """
+    bert = EmbeddingModel(EMBEDDING_MODEL).embed(PARITY_TEXTS, 8)
+    onnx = OnnxEmbeddingModel(output_dir).embed(PARITY_TEXTS, 8)
+
+    cosines = np.sum(normalize_rows(bert) * normalize_rows(onnx), axis=1)
+    for text, cosine in zip(PARITY_TEXTS, cosines):
+        print(f"{cosine:.4f}  {text[:60]!r}")
+
+    # the ranking is what retrieval depends on - compare text to text similarities too
+    bert_sims = normalize_rows(bert) @ normalize_rows(bert).T
+    onnx_sims = normalize_rows(onnx) @ normalize_rows(onnx).T
+    print(f"min cosine: {cosines.min():.4f}")
+    print(f"max similarity drift: {np.abs(bert_sims - onnx_sims).max():.4f}")
+
+    return bool(cosines.min() >= min_cosine)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", default="./models/bert-base-uncased-onnx")
+    parser.add_argument(
+        "--check", action="store_true", help="Only run the parity check"
+    )
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    args = parser.parse_args()
+
+    if not args.check:
+        export(args.output_dir)
+
+    if not check_parity(args.output_dir, args.min_cosine):
+        print("❌ onnx embeddings drifted from the BERT embeddings")
+        sys.exit(1)
+
+    print("✅ onnx embeddings match the BERT embeddings")
+
+
+if __name__ == "__main__":
+    main()
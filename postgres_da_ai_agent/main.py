@@ -10,6 +10,7 @@ from postgres_da_ai_agent.modules import orchestrator
 from postgres_da_ai_agent.modules import rand
 from postgres_da_ai_agent.modules import file
 from postgres_da_ai_agent.modules import embeddings
+from postgres_da_ai_agent.modules import context_builder
 from postgres_da_ai_agent.agents import agents
 import dotenv
 import argparse
@@ -85,25 +86,37 @@ def main():
 
         # -------- BUILD TABLE DEFINITIONS -----------
 
-        map_table_name_to_table_def = db.get_table_definition_map_for_embeddings()
+        database_embedder = embeddings.DatabaseEmbedder(db)
 
-        database_embedder = embeddings.DatabaseEmbedder()
+        database_embedder.add_schema_snapshot(db.get_schema_snapshot())
 
-        for name, table_def in map_table_name_to_table_def.items():
-            database_embedder.add_table(name, table_def)
+        similar_tables = database_embedder.get_similar_tables_with_scores(
+            raw_prompt, n=5
+        )
+
+        table_definitions_context = database_embedder.build_table_definitions_context(
+            similar_tables, raw_prompt
+        )
+        print(context_builder.describe(table_definitions_context))
 
-        similar_tables = database_embedder.get_similar_tables(raw_prompt, n=5)
+        table_definitions = table_definitions_context.table_definitions
 
-        table_definitions = database_embedder.get_table_definitions_from_names(
-            similar_tables
+        related_table_names = db.get_related_tables(
+            [table_name for table_name, _ in similar_tables], n=3
         )
 
-        related_table_names = db.get_related_tables(similar_tables, n=3)
+        # related tables only get the budget left over by the similar ones
+        core_and_related_table_definitions_context = (
+            database_embedder.build_table_definitions_context(
+                similar_tables
+                + [(table_name, 0.0) for table_name in related_table_names],
+                raw_prompt,
+            )
+        )
+        print(context_builder.describe(core_and_related_table_definitions_context))
 
         core_and_related_table_definitions = (
-            database_embedder.get_table_definitions_from_names(
-                related_table_names + similar_tables
-            )
+            core_and_related_table_definitions_context.table_definitions
         )
 
         prompt = llm.add_cap_ref(
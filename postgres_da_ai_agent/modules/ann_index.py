@@ -0,0 +1,180 @@
+"""
+Purpose:
+    Approximate nearest neighbour (HNSW) index over table embeddings for very large schemas.
+    Built in-process with hnswlib, persisted to disk and updated incrementally as tables change.
+
+    Optional - requires `pip install hnswlib`.
+"""
+
+import json
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+CACHE_DIR = os.environ.get("CACHE_DIR", "./.cache")
+
+HNSW_M = int(os.environ.get("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 64))
+
+
+class HnswTableIndex:
+    """
+    HNSW index of table embeddings keyed by table name
+
+    Every table name gets a stable integer label. A table is only
+    (re-)inserted when the content hash of its definition changes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        dim: int,
+        cache_dir: str = CACHE_DIR,
+        m: int = HNSW_M,
+        ef_construction: int = HNSW_EF_CONSTRUCTION,
+        ef_search: int = HNSW_EF_SEARCH,
+    ):
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError(
+                "hnswlib is required for the hnsw embedding search: pip install hnswlib"
+            )
+
+        self.hnswlib = hnswlib
+        self.dim = dim
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.lock = threading.Lock()
+
+        self.dir = os.path.join(cache_dir, "ann", name)
+        self.index_file = os.path.join(self.dir, "hnsw.bin")
+        self.labels_file = os.path.join(self.dir, "labels.json")
+
+        # table name -> (label, content hash)
+        self.map_name_to_label: Dict[str, Tuple[int, str]] = {}
+        self.label_names: Dict[int, str] = {}
+        self.index = None
+
+        self.load()
+
+    def __len__(self):
+        return len(self.map_name_to_label)
+
+    def new_index(self, max_elements: int):
+        index = self.hnswlib.Index(space="cosine", dim=self.dim)
+        index.init_index(
+            max_elements=max_elements, ef_construction=self.ef_construction, M=self.m
+        )
+        index.set_ef(self.ef_search)
+        return index
+
+    def load(self):
+        try:
+            with open(self.labels_file, "r") as f:
+                labels = json.load(f)
+        except (OSError, ValueError):
+            self.index = self.new_index(1024)
+            return
+
+        index = self.hnswlib.Index(space="cosine", dim=self.dim)
+        index.load_index(self.index_file, max_elements=max(1024, len(labels)))
+        index.set_ef(self.ef_search)
+
+        self.index = index
+        self.map_name_to_label = {
+            name: (label, text_hash) for name, (label, text_hash) in labels.items()
+        }
+        self.label_names = {label: name for name, (label, _) in labels.items()}
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+
+        self.index.save_index(self.index_file + suffix)
+        os.replace(self.index_file + suffix, self.index_file)
+
+        with open(self.labels_file + suffix, "w") as f:
+            json.dump(self.map_name_to_label, f)
+        os.replace(self.labels_file + suffix, self.labels_file)
+
+    def get_stale_rows(self, table_names: List[str], hashes: List[str]) -> List[int]:
+        """
+        Rows of table_names that are missing from the index or whose definition hash changed.
+        """
+        with self.lock:
+            return [
+                row
+                for row, (table_name, text_hash) in enumerate(zip(table_names, hashes))
+                if self.map_name_to_label.get(table_name, (None, None))[1] != text_hash
+            ]
+
+    def upsert(
+        self, table_names: List[str], hashes: List[str], embeddings: np.ndarray
+    ) -> int:
+        """
+        Insert new tables and re-insert tables whose definition hash changed.
+        Returns the number of tables written to the index.
+        """
+        with self.lock:
+            rows = []
+            labels = []
+            for row, (table_name, text_hash) in enumerate(zip(table_names, hashes)):
+                existing = self.map_name_to_label.get(table_name)
+                if existing is not None and existing[1] == text_hash:
+                    continue
+
+                label = existing[0] if existing else len(self.map_name_to_label)
+                self.map_name_to_label[table_name] = (label, text_hash)
+                self.label_names[label] = table_name
+                rows.append(row)
+                labels.append(label)
+
+            if not rows:
+                return 0
+
+            needed = len(self.map_name_to_label)
+            if needed > self.index.get_max_elements():
+                self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+
+            # hnswlib updates the vector in place when a label already exists
+            self.index.add_items(embeddings[rows], np.array(labels))
+            self.save()
+
+            return len(rows)
+
+    def query(self, embedding: np.ndarray, k: int) -> List[Tuple[str, float]]:
+        """
+        Approximate top k tables for an embedding as (table name, cosine similarity), best first.
+        """
+        with self.lock:
+            k = min(k, len(self))
+            if k <= 0:
+                return []
+
+            # hnsw can only return k results if the search beam is at least k wide
+            self.index.set_ef(max(self.ef_search, k))
+            labels, distances = self.index.knn_query(embedding.reshape(1, -1), k=k)
+
+        return [
+            (self.label_names[int(label)], 1 - float(distance))
+            for label, distance in zip(labels[0], distances[0])
+        ]
+
+
+_indexes: Dict[str, HnswTableIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_ann_index(name: str, dim: int) -> HnswTableIndex:
+    """
+    Get the shared index for a name, loading it from disk on first use.
+    """
+    with _indexes_lock:
+        if name not in _indexes:
+            _indexes[name] = HnswTableIndex(name, dim)
+        return _indexes[name]
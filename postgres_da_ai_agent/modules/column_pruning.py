@@ -0,0 +1,91 @@
+"""
+Purpose:
+    Prune wide tables down to the columns a prompt needs before they go into TABLE_DEFINITIONS.
+    Primary and foreign key columns are always kept so join paths survive.
+"""
+
+import os
+from typing import List, Optional
+
+import numpy as np
+
+from postgres_da_ai_agent.modules.token_index import tokenize
+from postgres_da_ai_agent.types import TableColumn
+
+# tables with at most this many columns are always sent whole
+COLUMN_PRUNE_MIN_COLUMNS = int(os.environ.get("COLUMN_PRUNE_MIN_COLUMNS", 30))
+# non-key columns kept per pruned table, on top of the ones named in the prompt
+COLUMN_PRUNE_TOP_N = int(os.environ.get("COLUMN_PRUNE_TOP_N", 15))
+
+
+def make_column_text(table_name: str, column: TableColumn) -> str:
+    """
+    Text embedded for a single column.
+    """
+    text = f"{table_name}.{column.name} {column.data_type}"
+    if column.comment:
+        text += f" {column.comment}"
+    return text
+
+
+def is_key_column(column: TableColumn) -> bool:
+    return column.primary_key or column.foreign_table is not None
+
+
+def select_columns(
+    columns: List[TableColumn],
+    query: str,
+    scores: Optional[np.ndarray] = None,
+    top_n: int = COLUMN_PRUNE_TOP_N,
+) -> List[TableColumn]:
+    """
+    Columns to keep for a query, in ordinal order.
+
+    Keeps every key column and every column whose name is spelled out in the
+    query, then the top_n best scoring others. scores are aligned with columns;
+    without them the leading columns are kept.
+    """
+    query_tokens = set(tokenize(query))
+
+    keep = set()
+    candidates = []
+    for index, column in enumerate(columns):
+        column_tokens = set(tokenize(column.name))
+        if is_key_column(column) or (column_tokens and column_tokens <= query_tokens):
+            keep.add(index)
+        else:
+            candidates.append(index)
+
+    if scores is not None:
+        candidates.sort(key=lambda index: -scores[index])
+    keep.update(candidates[:top_n])
+
+    return [columns[index] for index in sorted(keep)]
+
+
+def make_pruned_table_definition(
+    table_name: str, columns: List[TableColumn], n_columns: int
+) -> str:
+    """
+    'create' definition of the kept columns, with their key constraints spelled out
+    and a note of how many of the table's n_columns were left out.
+    """
+    primary_key = [column.name for column in columns if column.primary_key]
+
+    create_table_stmt = "CREATE TABLE {} (\n".format(table_name)
+    for column in columns:
+        column_def = "{} {}".format(column.name, column.data_type)
+        if len(primary_key) == 1 and column.primary_key:
+            column_def += " PRIMARY KEY"
+        if column.foreign_table is not None:
+            column_def += " REFERENCES {}".format(column.foreign_table)
+        create_table_stmt += column_def + ",\n"
+    if len(primary_key) > 1:
+        create_table_stmt += "PRIMARY KEY ({}),\n".format(", ".join(primary_key))
+    create_table_stmt = create_table_stmt.rstrip(",\n")
+
+    n_omitted = n_columns - len(columns)
+    if n_omitted > 0:
+        create_table_stmt += "\n-- {} more columns omitted".format(n_omitted)
+
+    return create_table_stmt + "\n);"
@@ -0,0 +1,85 @@
+"""
+Purpose:
+    Pack table definitions into a fixed token budget for the TABLE_DEFINITIONS cap ref.
+
+    Tables are taken in relevance order. Each goes in whole if it fits, else
+    shortened to its key columns if that fits, else it is dropped - so prompt
+    size, latency and cost stay bounded however wide the matched tables are.
+"""
+
+import os
+from typing import List, Optional, Tuple
+
+from postgres_da_ai_agent.modules import tokens
+from postgres_da_ai_agent.types import TableDefinitionsContext
+
+TABLE_DEFINITIONS_TOKEN_BUDGET = int(
+    os.environ.get("TABLE_DEFINITIONS_TOKEN_BUDGET", 4000)
+)
+
+TABLE_DEFINITIONS_SEPARATOR = "\n\n"
+
+
+def build_table_definitions_context(
+    tables: List[Tuple[str, float, str, Optional[str]]],
+    token_budget: int = TABLE_DEFINITIONS_TOKEN_BUDGET,
+) -> TableDefinitionsContext:
+    """
+    Greedily pack table definitions into token_budget tokens.
+
+    tables holds (table name, relevance score, definition, shortened definition or None).
+    Higher scores are packed first, ties keep their given order. The packed
+    definitions keep that order too.
+    """
+    separator_tokens = tokens.count_tokens(TABLE_DEFINITIONS_SEPARATOR)
+
+    table_defs = []
+    included = []
+    shortened = []
+    dropped = []
+    used_tokens = 0
+
+    for table_name, _, table_def, short_table_def in sorted(
+        tables, key=lambda table: -table[1]
+    ):
+        if table_name in included or table_name in dropped:
+            continue
+
+        overhead = separator_tokens if table_defs else 0
+
+        table_def_tokens = tokens.count_tokens(table_def)
+        if used_tokens + overhead + table_def_tokens <= token_budget:
+            table_defs.append(table_def)
+            included.append(table_name)
+            used_tokens += overhead + table_def_tokens
+            continue
+
+        if short_table_def is not None:
+            short_table_def_tokens = tokens.count_tokens(short_table_def)
+            if used_tokens + overhead + short_table_def_tokens <= token_budget:
+                table_defs.append(short_table_def)
+                included.append(table_name)
+                shortened.append(table_name)
+                used_tokens += overhead + short_table_def_tokens
+                continue
+
+        dropped.append(table_name)
+
+    return TableDefinitionsContext(
+        table_definitions=TABLE_DEFINITIONS_SEPARATOR.join(table_defs),
+        tokens=used_tokens,
+        token_budget=token_budget,
+        included=included,
+        shortened=shortened,
+        dropped=dropped,
+    )
+
+
+def describe(context: TableDefinitionsContext) -> str:
+    """
+    One line summary of what made it into the context and what didn't.
+    """
+    return (
+        f"TABLE_DEFINITIONS: {context.tokens}/{context.token_budget} tokens, "
+        f"included: {context.included}, shortened: {context.shortened}, dropped: {context.dropped}"
+    )
@@ -1,7 +1,200 @@
 from datetime import datetime
-import json
+from collections import deque
+import hashlib
+import os
+import threading
+import time
 import psycopg2
+import psycopg2.errors
+from psycopg2.pool import PoolError
 from psycopg2.sql import SQL, Identifier
+from typing import Dict, Iterator, List, Tuple
+import io
+import uuid
+
+from postgres_da_ai_agent.modules import schema_cache, serializers
+from postgres_da_ai_agent.modules.fk_graph import ForeignKeyGraph
+from postgres_da_ai_agent.types import ForeignKey, SchemaSnapshot, TableColumn
+
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", 1800))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+
+RUN_SQL_BATCH_SIZE = int(os.environ.get("RUN_SQL_BATCH_SIZE", 1000))
+
+# statements postgres accepts inside DECLARE ... CURSOR
+CURSOR_STATEMENTS = ("select", "with", "values", "table")
+
+
+class PostgresConnectionPool:
+    """
+    A thread safe pool of postgres connections
+
+    - Opens min_size connections up front and never more than max_size
+    - Health checks a connection before handing it out
+    - Retires connections older than max_lifetime seconds
+    - Rolls back and resets connections when they are returned
+    """
+
+    def __init__(
+        self,
+        url: str,
+        min_size: int = POOL_MIN_SIZE,
+        max_size: int = POOL_MAX_SIZE,
+        max_lifetime: float = POOL_MAX_LIFETIME,
+        timeout: float = POOL_TIMEOUT,
+    ):
+        if min_size > max_size:
+            raise ValueError(f"min_size {min_size} is larger than max_size {max_size}")
+
+        self.url = url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+
+        self.idle = deque()  # (conn, created_at) ready to be borrowed
+        # id(conn) -> creation time, for every open conn
+        self.created_at: Dict[int, float] = {}
+        self.size = 0
+        self.closed = False
+        self.lock = threading.Condition()
+
+        for _ in range(min_size):
+            self.size += 1
+            conn = self._connect()
+            self.idle.append((conn, self.created_at[id(conn)]))
+
+    def _connect(self):
+        """
+        Open a new connection. The caller must already have reserved a slot in self.size.
+        """
+        try:
+            conn = psycopg2.connect(self.url)
+        except Exception:
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self.lock:
+            if self.created_at.pop(id(conn), None) is not None:
+                self.size -= 1
+            self.lock.notify()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return time.monotonic() - created_at > self.max_lifetime
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """
+        Borrow a connection, waiting up to timeout seconds for one to free up.
+        """
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            conn = None
+            with self.lock:
+                if self.closed:
+                    raise PoolError("connection pool is closed")
+
+                while not self.idle and self.size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolError(
+                            f"no connection available after {self.timeout}s (max_size={self.max_size})"
+                        )
+                    self.lock.wait(remaining)
+
+                if self.idle:
+                    conn, created_at = self.idle.pop()
+                else:
+                    # reserve the slot while holding the lock so we never exceed max_size
+                    self.size += 1
+
+            if conn is None:
+                return self._connect()
+
+            if self._is_expired(created_at) or not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+
+            return conn
+
+    def putconn(self, conn):
+        """
+        Return a borrowed connection to the pool.
+        """
+        with self.lock:
+            created_at = self.created_at.get(id(conn))
+
+        if created_at is None:
+            raise PoolError("connection does not belong to this pool")
+
+        if self.closed or conn.closed or self._is_expired(created_at):
+            self._discard(conn)
+            return
+
+        try:
+            # rolls back any open transaction and resets session state
+            conn.reset()
+        except psycopg2.Error:
+            self._discard(conn)
+            return
+
+        with self.lock:
+            self.idle.append((conn, created_at))
+            self.lock.notify()
+
+    def closeall(self):
+        """
+        Close every idle connection and refuse new borrows.
+        Borrowed connections are closed when they are returned.
+        """
+        with self.lock:
+            self.closed = True
+            idle = list(self.idle)
+            self.idle.clear()
+            self.lock.notify_all()
+
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+# process wide pools, one per database url
+_pools: Dict[str, PostgresConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(url: str) -> PostgresConnectionPool:
+    """
+    Get the shared connection pool for a database url, creating it on first use.
+    """
+    with _pools_lock:
+        pool = _pools.get(url)
+        if pool is None or pool.closed:
+            pool = PostgresConnectionPool(url)
+            _pools[url] = pool
+        return pool
 
 
 class PostgresManager:
@@ -12,39 +205,133 @@ class PostgresManager:
     def __init__(self):
         self.conn = None
         self.cur = None
+        self.pool = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.cur:
-            self.cur.close()
-        if self.conn:
-            self.conn.close()
+        self.close()
 
     def connect_with_url(self, url):
         self.conn = psycopg2.connect(url)
         self.cur = self.conn.cursor()
 
+    def connect_with_pool(self, pool: PostgresConnectionPool):
+        """
+        Borrow a connection from a pool. close() hands it back instead of closing it.
+        """
+        self.pool = pool
+        self.conn = pool.getconn()
+        self.cur = self.conn.cursor()
+
     def close(self):
         if self.cur:
             self.cur.close()
         if self.conn:
-            self.conn.close()
+            if self.pool:
+                self.pool.putconn(self.conn)
+            else:
+                self.conn.close()
+        self.cur = None
+        self.conn = None
+        self.pool = None
 
-    def run_sql(self, sql) -> str:
+    def run_sql(self, sql, results_format: str = "json") -> str:
         """
         Run a SQL query against the postgres database
         """
+        f = io.StringIO()
+        self.write_results(sql, f, results_format)
+        return f.getvalue()
+
+    def run_sql_stream(
+        self, sql, batch_size: int = RUN_SQL_BATCH_SIZE
+    ) -> Iterator[Tuple[List[str], List[tuple]]]:
+        """
+        Run a SQL query and yield (columns, rows) batches of at most batch_size rows.
+        Queries without rows yield a single empty batch so serializers still get the columns.
+
+        Queries run on a named server-side cursor so only one batch is held in memory.
+        Other statements, and queries DECLARE rejects (data-modifying WITH, SELECT ... INTO),
+        fall back to the regular client-side cursor.
+        """
+        words = sql.lstrip().split(None, 1)
+        is_query = bool(words) and words[0].lower() in CURSOR_STATEMENTS
+
+        if is_query:
+            cur = self.conn.cursor(name=f"run_sql_{uuid.uuid4().hex}")
+            cur.itersize = batch_size
+
+            # a rejected DECLARE aborts the transaction - the savepoint keeps what ran before it
+            self.cur.execute("SAVEPOINT run_sql_stream")
+            try:
+                cur.execute(sql)
+            except (psycopg2.errors.FeatureNotSupported, psycopg2.errors.SyntaxError):
+                # the cursor was never declared, so it's dropped without closing
+                self.cur.execute("ROLLBACK TO SAVEPOINT run_sql_stream")
+                cur = None
+            else:
+                self.cur.execute("RELEASE SAVEPOINT run_sql_stream")
+
+            if cur is not None:
+                try:
+                    yield from self.fetch_batches(cur, batch_size)
+                finally:
+                    cur.close()
+                return
+
         self.cur.execute(sql)
-        columns = [desc[0] for desc in self.cur.description]
-        res = self.cur.fetchall()
+        if self.cur.description is None:
+            return
+        yield from self.fetch_batches(self.cur, batch_size)
 
-        list_of_dicts = [dict(zip(columns, row)) for row in res]
+    @staticmethod
+    def fetch_batches(cur, batch_size: int) -> Iterator[Tuple[List[str], List[tuple]]]:
+        """
+        Yield (columns, rows) batches from an executed cursor.
+        An empty result still yields its columns once.
+        """
+        rows = cur.fetchmany(batch_size)
+        # named cursors only know their columns after the first fetch
+        columns = [desc[0] for desc in cur.description]
 
-        json_result = json.dumps(list_of_dicts, indent=4, default=self.datetime_handler)
+        yield columns, rows
+        while rows:
+            rows = cur.fetchmany(batch_size)
+            if rows:
+                yield columns, rows
+
+    def write_results(
+        self,
+        sql,
+        f,
+        results_format: str = "json",
+        batch_size: int = RUN_SQL_BATCH_SIZE,
+    ) -> int:
+        """
+        Run a SQL query and serialize the results into an open file batch by batch.
+        """
+        serializer = serializers.get_serializer(results_format)(f)
+        for columns, rows in self.run_sql_stream(sql, batch_size):
+            serializer.write_batch(columns, rows)
+        serializer.close()
+        return serializer.row_count
 
-        return json_result
+    def run_sql_to_file(
+        self,
+        sql,
+        fname: str,
+        results_format: str = "json",
+        batch_size: int = RUN_SQL_BATCH_SIZE,
+    ) -> int:
+        """
+        Run a SQL query and stream the results into a file without materialising the full result.
+        See modules/serializers.py for the available formats.
+        """
+        mode = "wb" if serializers.get_serializer(results_format).binary else "w"
+        with open(fname, mode) as f:
+            return self.write_results(sql, f, results_format, batch_size)
 
     def datetime_handler(self, obj):
         """
@@ -63,19 +350,32 @@ class PostgresManager:
         SELECT pg_class.relname as tablename,
             pg_attribute.attnum,
             pg_attribute.attname,
-            format_type(atttypid, atttypmod)
+            format_type(atttypid, atttypmod),
+            pg_attribute.attnotnull
         FROM pg_class
         JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
         JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid
         WHERE pg_attribute.attnum > 0
+            AND NOT pg_attribute.attisdropped
             AND pg_class.relname = %s
             AND pg_namespace.nspname = 'public'  -- Assuming you're interested in public schema
+        ORDER BY pg_attribute.attnum
         """
         self.cur.execute(get_def_stmt, (table_name,))
         rows = self.cur.fetchall()
+        columns = [
+            TableColumn(name=row[2], data_type=row[3], not_null=row[4], position=row[1])
+            for row in rows
+        ]
+        return self.make_table_definition(table_name, columns)
+
+    def make_table_definition(self, table_name: str, columns: List[TableColumn]):
+        """
+        Build the 'create' definition for a table from its columns
+        """
         create_table_stmt = "CREATE TABLE {} (\n".format(table_name)
-        for row in rows:
-            create_table_stmt += "{} {},\n".format(row[2], row[3])
+        for column in columns:
+            create_table_stmt += "{} {},\n".format(column.name, column.data_type)
         create_table_stmt = create_table_stmt.rstrip(",\n") + "\n);"
         return create_table_stmt
 
@@ -89,75 +389,248 @@ class PostgresManager:
         self.cur.execute(get_all_tables_stmt)
         return [row[0] for row in self.cur.fetchall()]
 
-    def get_table_definitions_for_prompt(self):
+    def get_table_columns_map(self) -> Dict[str, List[TableColumn]]:
         """
-        Get all table 'create' definitions in the database
+        Load the columns of every table in the public schema in a single round trip.
+
+        Returns a map of table names to their columns ordered by ordinal position,
+        each flagged with whether it is part of the primary key and the table it references, if any.
         """
-        table_names = self.get_all_table_names()
-        definitions = []
-        for table_name in table_names:
-            definitions.append(self.get_table_definition(table_name))
-        return "\n\n".join(definitions)
 
-    def get_table_definition_map_for_embeddings(self):
+        get_columns_stmt = """
+        SELECT pg_class.relname AS tablename,
+            pg_attribute.attnum,
+            pg_attribute.attname,
+            format_type(pg_attribute.atttypid, pg_attribute.atttypmod),
+            pg_attribute.attnotnull,
+            col_description(pg_class.oid, pg_attribute.attnum),
+            coalesce(keys.primary_key, false),
+            keys.foreign_table
+        FROM pg_class
+        JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+        LEFT JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid
+            AND pg_attribute.attnum > 0
+            AND NOT pg_attribute.attisdropped
+        LEFT JOIN LATERAL (
+            SELECT bool_or(pg_constraint.contype = 'p') AS primary_key,
+                min(referenced.relname) FILTER (WHERE pg_constraint.contype = 'f') AS foreign_table
+            FROM pg_constraint
+            LEFT JOIN pg_class referenced ON referenced.oid = pg_constraint.confrelid
+            WHERE pg_constraint.conrelid = pg_class.oid
+                AND pg_constraint.contype IN ('p', 'f')
+                AND pg_attribute.attnum = ANY(pg_constraint.conkey)
+        ) keys ON true
+        WHERE pg_class.relkind IN ('r', 'p')  -- same relations as pg_tables
+            AND pg_namespace.nspname = 'public'
+        ORDER BY pg_class.relname, pg_attribute.attnum
         """
-        Creates a map of table names to table definitions
+        self.cur.execute(get_columns_stmt)
+
+        columns_map: Dict[str, List[TableColumn]] = {}
+        for row in self.cur.fetchall():
+            (
+                table_name,
+                position,
+                name,
+                data_type,
+                not_null,
+                comment,
+                primary_key,
+                foreign_table,
+            ) = row
+            columns = columns_map.setdefault(table_name, [])
+            # tables without columns still get an (empty) entry
+            if name is not None:
+                columns.append(
+                    TableColumn(
+                        name=name,
+                        data_type=data_type,
+                        not_null=not_null,
+                        position=position,
+                        comment=comment,
+                        primary_key=primary_key,
+                        foreign_table=foreign_table,
+                    )
+                )
+
+        return columns_map
+
+    def get_table_comments(self) -> Dict[str, str]:
         """
-        table_names = self.get_all_table_names()
-        definitions = {}
-        for table_name in table_names:
-            definitions[table_name] = self.get_table_definition(table_name)
-        return definitions
-
-    def get_related_tables(self, table_list, n=2):
-        """
-        Get tables that have foreign keys referencing the given table
-        """
-
-        related_tables_dict = {}
-
-        for table in table_list:
-            # Query to fetch tables that have foreign keys referencing the given table
-            self.cur.execute(
-                """
-                SELECT 
-                    a.relname AS table_name
-                FROM 
-                    pg_constraint con 
-                    JOIN pg_class a ON a.oid = con.conrelid 
-                WHERE 
-                    confrelid = (SELECT oid FROM pg_class WHERE relname = %s)
-                LIMIT %s;
-                """,
-                (table, n),
+        Map of table names to their COMMENT ON TABLE text, for tables that have one.
+        """
+        self.cur.execute("""
+            SELECT relname, obj_description(oid, 'pg_class')
+            FROM pg_class
+            WHERE relkind IN ('r', 'p')
+                AND relnamespace = 'public'::regnamespace
+                AND obj_description(oid, 'pg_class') IS NOT NULL
+            """)
+        return dict(self.cur.fetchall())
+
+    def get_foreign_keys(self) -> List[ForeignKey]:
+        """
+        Load every foreign key between tables of the public schema in a single round trip.
+        """
+        self.cur.execute("""
+            SELECT source.relname,
+                ARRAY(
+                    SELECT pg_attribute.attname::text
+                    FROM unnest(pg_constraint.conkey) WITH ORDINALITY AS keys(attnum, i)
+                    JOIN pg_attribute ON pg_attribute.attrelid = pg_constraint.conrelid
+                        AND pg_attribute.attnum = keys.attnum
+                    ORDER BY keys.i
+                ),
+                target.relname,
+                ARRAY(
+                    SELECT pg_attribute.attname::text
+                    FROM unnest(pg_constraint.confkey) WITH ORDINALITY AS keys(attnum, i)
+                    JOIN pg_attribute ON pg_attribute.attrelid = pg_constraint.confrelid
+                        AND pg_attribute.attnum = keys.attnum
+                    ORDER BY keys.i
+                )
+            FROM pg_constraint
+            JOIN pg_class source ON source.oid = pg_constraint.conrelid
+            JOIN pg_class target ON target.oid = pg_constraint.confrelid
+            WHERE pg_constraint.contype = 'f'
+                AND source.relnamespace = 'public'::regnamespace
+                AND target.relnamespace = 'public'::regnamespace
+            ORDER BY source.relname, pg_constraint.conname
+            """)
+        return [
+            ForeignKey(
+                table_name=table_name,
+                column_names=column_names,
+                foreign_table_name=foreign_table_name,
+                foreign_column_names=foreign_column_names,
             )
+            for (
+                table_name,
+                column_names,
+                foreign_table_name,
+                foreign_column_names,
+            ) in self.cur.fetchall()
+        ]
+
+    def get_database_identity(self) -> str:
+        """
+        Stable key for the connected database - host, port, database and user.
+        """
+        params = self.conn.get_dsn_parameters()
+        identity = "{}:{}/{}@{}".format(
+            params.get("host"),
+            params.get("port"),
+            params.get("dbname"),
+            params.get("user"),
+        )
+        return hashlib.sha256(identity.encode()).hexdigest()[:16]
+
+    def get_catalog_fingerprint(self) -> str:
+        """
+        Cheap fingerprint of the public schema catalog.
+
+        Any DDL touching a table or column writes a new pg_class / pg_attribute row version,
+        which moves the max xmin. The row count catches dropped tables.
+        COMMENT ON lives in pg_description and keys in pg_constraint, so they get the same count + max xmin.
+        """
+        self.cur.execute("""
+            SELECT count(*),
+                max(pg_class.xmin::text::bigint),
+                max(pg_attribute.xmin::text::bigint),
+                (
+                    SELECT count(*) || '.' || coalesce(max(pg_description.xmin::text::bigint), 0)
+                    FROM pg_description
+                    JOIN pg_class ON pg_class.oid = pg_description.objoid
+                    WHERE pg_description.classoid = 'pg_class'::regclass
+                        AND pg_class.relnamespace = 'public'::regnamespace
+                ),
+                (
+                    SELECT count(*) || '.' || coalesce(max(pg_constraint.xmin::text::bigint), 0)
+                    FROM pg_constraint
+                    WHERE pg_constraint.connamespace = 'public'::regnamespace
+                )
+            FROM pg_class
+            LEFT JOIN pg_attribute ON pg_attribute.attrelid = pg_class.oid
+            WHERE pg_class.relnamespace = 'public'::regnamespace
+            """)
+        return ":".join(str(value) for value in self.cur.fetchone())
+
+    def get_schema_fingerprint(self) -> str:
+        """
+        Fingerprint of this database's table definitions - differs between databases and only
+        changes when a definition does. Unlike the catalog fingerprint it survives TRUNCATE,
+        VACUUM FULL, CLUSTER and REFRESH MATERIALIZED VIEW, which rewrite pg_class rows.
+        """
+        table_definitions = self.get_schema_snapshot().table_definitions
 
-            related_tables = [row[0] for row in self.cur.fetchall()]
-
-            # Query to fetch tables that the given table references
-            self.cur.execute(
-                """
-                SELECT 
-                    a.relname AS referenced_table_name
-                FROM 
-                    pg_constraint con 
-                    JOIN pg_class a ON a.oid = con.confrelid 
-                WHERE 
-                    conrelid = (SELECT oid FROM pg_class WHERE relname = %s)
-                LIMIT %s;
-                """,
-                (table, n),
+        definitions_hash = hashlib.sha256()
+        for table_name in sorted(table_definitions):
+            definitions_hash.update(
+                f"{table_name}\n{table_definitions[table_name]}\n".encode()
             )
 
-            related_tables += [row[0] for row in self.cur.fetchall()]
+        return "{}:{}".format(
+            self.get_database_identity(), definitions_hash.hexdigest()
+        )
+
+    def get_schema_snapshot(self) -> SchemaSnapshot:
+        """
+        Get the schema snapshot for the database, re-reading the catalog only after DDL.
+        """
+        identity = self.get_database_identity()
+        fingerprint = self.get_catalog_fingerprint()
 
-            related_tables_dict[table] = related_tables
+        snapshot = schema_cache.get_snapshot(identity, fingerprint)
+        if snapshot is not None:
+            return snapshot
+
+        table_columns = self.get_table_columns_map()
+        snapshot = SchemaSnapshot(
+            fingerprint=fingerprint,
+            table_columns=table_columns,
+            table_definitions={
+                table_name: self.make_table_definition(table_name, columns)
+                for table_name, columns in table_columns.items()
+            },
+            table_comments=self.get_table_comments(),
+            foreign_keys=self.get_foreign_keys(),
+        )
+        schema_cache.put_snapshot(identity, snapshot)
 
-        # convert dict to list and remove dups
-        related_tables_list = []
-        for table, related_tables in related_tables_dict.items():
-            related_tables_list += related_tables
+        return snapshot
 
-        related_tables_list = list(set(related_tables_list))
+    def get_table_definitions_for_prompt(self):
+        """
+        Get all table 'create' definitions in the database
+        """
+        definitions = self.get_table_definition_map_for_embeddings()
+        return "\n\n".join(definitions.values())
 
-        return related_tables_list
+    def get_table_definition_map_for_embeddings(self):
+        """
+        Creates a map of table names to table definitions
+        """
+        return self.get_schema_snapshot().table_definitions
+
+    def get_foreign_key_graph(self) -> ForeignKeyGraph:
+        """
+        Foreign key graph of the public schema, built once per schema snapshot.
+        """
+        return schema_cache.get_foreign_key_graph(
+            self.get_database_identity(), self.get_schema_snapshot()
+        )
+
+    def get_related_tables(self, table_list, n=2, hops=1):
+        """
+        Get tables that have foreign keys referencing the given tables
+        and tables the given tables reference, up to n of each per table.
+
+        hops > 1 follows foreign keys further out from the given tables.
+        """
+        return self.get_foreign_key_graph().get_related_tables(table_list, n, hops)
+
+    def get_join_path_tables(self, table_list):
+        """
+        Get the tables needed to join the given tables together along the shortest foreign key paths.
+        """
+        return self.get_foreign_key_graph().get_join_path_tables(table_list)
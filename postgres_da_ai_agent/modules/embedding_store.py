@@ -0,0 +1,209 @@
+"""
+Purpose:
+    Persist text embeddings on local disk so unchanged table definitions are never re-embedded.
+
+    Several processes can share a store: appends and index writes happen under an
+    exclusive lock on the lock file, after reloading the index another process may have grown.
+
+Layout:
+    CACHE_DIR/embeddings/<model_name>/embeddings.f32 - append only float32 rows, memory mapped on read
+    CACHE_DIR/embeddings/<model_name>/index.json     - row count and size, content hash -> row, name -> content hash
+    CACHE_DIR/embeddings/<model_name>/lock           - flock'ed while appending
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+CACHE_DIR = os.environ.get("CACHE_DIR", "./.cache")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Embeddings keyed by model name and a content hash of the embedded text
+    """
+
+    def __init__(self, model_name: str, cache_dir: str = CACHE_DIR):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, "embeddings", model_name.replace("/", "__"))
+        self.matrix_file = os.path.join(self.dir, "embeddings.f32")
+        self.index_file = os.path.join(self.dir, "index.json")
+        self.lock_file = os.path.join(self.dir, "lock")
+        self.lock = threading.Lock()
+
+        self.map_hash_to_row: Dict[str, int] = {}
+        self.map_name_to_hash: Dict[str, str] = {}
+        # rows the index covers - the matrix file may hold more after an interrupted save
+        self.n_rows = 0
+        self.dim = 0
+        self.matrix: Optional[np.ndarray] = None
+
+        self.load()
+
+    def load(self):
+        """
+        Load the index and memory map the embedding matrix.
+        A missing or unreadable index leaves the store empty.
+        """
+        try:
+            with open(self.index_file, "r") as f:
+                index = json.load(f)
+            n_rows, dim = index["rows"], index["dim"]
+            map_hash_to_row, map_name_to_hash = index["hashes"], index["names"]
+            # rows are only ever appended so an index older than the matrix is still valid
+            if os.path.getsize(self.matrix_file) < n_rows * dim * 4:
+                raise ValueError("embedding matrix is shorter than its index")
+        except (OSError, ValueError, KeyError, TypeError):
+            n_rows, dim, map_hash_to_row, map_name_to_hash = 0, 0, {}, {}
+
+        self.map_hash_to_row = map_hash_to_row
+        self.map_name_to_hash = map_name_to_hash
+        self.n_rows = n_rows
+        self.dim = dim
+        self.map_matrix()
+
+    def map_matrix(self):
+        self.matrix = None
+        if self.n_rows:
+            self.matrix = np.memmap(
+                self.matrix_file,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.n_rows, self.dim),
+            )
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        """
+        Exclusive across processes sharing the store - held while appending and saving the index.
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append_rows(self, embeddings: np.ndarray):
+        """
+        Write new rows after the ones the index covers - the existing rows are never rewritten.
+        Call under file_lock() with a freshly loaded index.
+        """
+        mode = "r+b" if os.path.exists(self.matrix_file) else "wb"
+        with open(self.matrix_file, mode) as f:
+            f.seek(self.n_rows * self.dim * 4)
+            f.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+            # drop rows left behind by an interrupted save - the on-disk index doesn't cover them
+            f.truncate()
+
+        self.n_rows += len(embeddings)
+        self.dim = embeddings.shape[1]
+
+    def save_index(self):
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+
+        # written after the matrix rows so the index never points past the matrix
+        with open(self.index_file + suffix, "w") as f:
+            json.dump(
+                {
+                    "rows": self.n_rows,
+                    "dim": self.dim,
+                    "hashes": self.map_hash_to_row,
+                    "names": self.map_name_to_hash,
+                },
+                f,
+            )
+        os.replace(self.index_file + suffix, self.index_file)
+
+    def get_embeddings(
+        self,
+        names: List[str],
+        texts: List[str],
+        compute_embeddings: Callable[[List[str]], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Get the embeddings of texts, only computing the ones not already stored.
+
+        names label the texts (ie. table names) in the index.
+        compute_embeddings is called with the missing texts - once, unless another
+        process changed the store in between.
+        """
+        if not texts:
+            return compute_embeddings([])
+
+        hashes = [content_hash(text) for text in texts]
+        map_hash_to_text = dict(zip(hashes, texts))
+
+        with self.lock:
+            missing = [h for h in map_hash_to_text if h not in self.map_hash_to_row]
+            names_changed = any(
+                self.map_name_to_hash.get(name) != text_hash
+                for name, text_hash in zip(names, hashes)
+            )
+
+            if missing or names_changed:
+                # embed outside the file lock, other processes only wait for the write
+                computed = {}
+                if missing:
+                    new_embeddings = compute_embeddings(
+                        [map_hash_to_text[h] for h in missing]
+                    )
+                    computed = dict(zip(missing, new_embeddings.astype(np.float32)))
+
+                with self.file_lock():
+                    # pick up the rows other processes appended since we last loaded
+                    self.load()
+
+                    missing = [
+                        h for h in map_hash_to_text if h not in self.map_hash_to_row
+                    ]
+                    uncomputed = [h for h in missing if h not in computed]
+                    if uncomputed:
+                        computed.update(
+                            zip(
+                                uncomputed,
+                                compute_embeddings(
+                                    [map_hash_to_text[h] for h in uncomputed]
+                                ).astype(np.float32),
+                            )
+                        )
+
+                    if missing:
+                        start = self.n_rows
+                        self.append_rows(np.stack([computed[h] for h in missing]))
+                        for offset, text_hash in enumerate(missing):
+                            self.map_hash_to_row[text_hash] = start + offset
+
+                    self.map_name_to_hash.update(zip(names, hashes))
+                    self.save_index()
+
+                self.map_matrix()
+
+            # fancy indexing reads just these rows off the memory map
+            rows = [self.map_hash_to_row[text_hash] for text_hash in hashes]
+            return np.asarray(self.matrix[rows], dtype=np.float32)
+
+
+_stores: Dict[str, EmbeddingStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_embedding_store(model_name: str) -> EmbeddingStore:
+    """
+    Get the shared embedding store for a model.
+    """
+    with _stores_lock:
+        if model_name not in _stores:
+            _stores[model_name] = EmbeddingStore(model_name)
+        return _stores[model_name]
@@ -1,7 +1,150 @@
-from sklearn.metrics.pairwise import cosine_similarity
-from transformers import BertTokenizer, BertModel
+import os
+import threading
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
+
+from postgres_da_ai_agent.modules import (
+    ann_index,
+    column_pruning,
+    context_builder,
+    embedding_store,
+    retrieval,
+)
+from postgres_da_ai_agent.modules.onnx_embeddings import OnnxEmbeddingModel
+from postgres_da_ai_agent.modules.ann_index import HnswTableIndex
 from postgres_da_ai_agent.modules.db import PostgresManager
+from postgres_da_ai_agent.modules.token_index import TokenIndex
+from postgres_da_ai_agent.types import (
+    SchemaSnapshot,
+    TableColumn,
+    TableDefinitionsContext,
+)
+
+EMBEDDING_MODEL = "bert-base-uncased"
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 32))
+
+# 'bert' runs EMBEDDING_MODEL with torch, 'onnx' runs the int8 export in ONNX_MODEL_DIR without torch
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "bert")
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "./models/bert-base-uncased-onnx")
+
+# 'exact' scans every table embedding, 'hnsw' uses an approximate index (requires hnswlib)
+EMBEDDING_SEARCH = os.environ.get("EMBEDDING_SEARCH", "exact")
+# below this many tables the exact scan is fast enough and the hnsw index is skipped
+ANN_MIN_TABLES = int(os.environ.get("ANN_MIN_TABLES", 10000))
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scale every row to unit length so a dot product is a cosine similarity.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, best first, without sorting every score.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=int)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class EmbeddingModel:
+    """
+    Tokenizer and model weights loaded once, on first use, and shared
+    by every DatabaseEmbedder in the process (and across threads).
+    """
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.name = model_name
+        self.lock = threading.Lock()
+        self.tokenizer = None
+        self.model = None
+
+    def load(self):
+        if self.model is not None:
+            return self
+        with self.lock:
+            if self.model is None:
+                from transformers import BertTokenizer, BertModel
+
+                print(f"Loading embedding model {self.model_name}")
+                self.tokenizer = BertTokenizer.from_pretrained(self.model_name)
+                model = BertModel.from_pretrained(self.model_name)
+                model.eval()
+                self.model = model
+        return self
+
+    def embed(self, texts: List[str], batch_size: int) -> np.ndarray:
+        """
+        Compute embeddings for many texts using the BERT model.
+
+        Texts are tokenized together, sorted by length so each padded
+        mini-batch wastes as little compute as possible, and written
+        into one contiguous (len(texts), hidden_size) matrix.
+        """
+        import torch
+
+        self.load()
+
+        embeddings = np.empty(
+            (len(texts), self.model.config.hidden_size), dtype=np.float32
+        )
+        if not texts:
+            return embeddings
+
+        encodings = self.tokenizer(texts, truncation=True, max_length=512)
+        order = sorted(range(len(texts)), key=lambda i: len(encodings["input_ids"][i]))
+
+        with torch.inference_mode():
+            for start in range(0, len(order), batch_size):
+                batch_indices = order[start : start + batch_size]
+                batch = self.tokenizer.pad(
+                    {
+                        key: [values[i] for i in batch_indices]
+                        for key, values in encodings.items()
+                    },
+                    return_tensors="pt",
+                )
+                outputs = self.model(**batch)
+                embeddings[batch_indices] = outputs["pooler_output"].numpy()
+
+        return embeddings
+
+
+_embedding_models: Dict[str, Union[EmbeddingModel, OnnxEmbeddingModel]] = {}
+_embedding_models_lock = threading.Lock()
+
+
+def get_embedding_model(
+    backend: str = EMBEDDING_BACKEND,
+) -> Union[EmbeddingModel, OnnxEmbeddingModel]:
+    """
+    Get the process wide holder for a backend's model. Weights are not loaded until first use.
+    """
+    with _embedding_models_lock:
+        if backend not in _embedding_models:
+            if backend == "onnx":
+                _embedding_models[backend] = OnnxEmbeddingModel(ONNX_MODEL_DIR)
+            elif backend == "bert":
+                _embedding_models[backend] = EmbeddingModel(EMBEDDING_MODEL)
+            else:
+                raise ValueError(f"Unknown embedding backend '{backend}'")
+        return _embedding_models[backend]
+
+
+def warm_up(backend: str = EMBEDDING_BACKEND):
+    """
+    Load the model weights and run one tiny forward pass.
+    Call at server boot so the first user request doesn't pay the load cost.
+    """
+    get_embedding_model(backend).embed(["warm up"], 1)
 
 
 class DatabaseEmbedder:
@@ -11,50 +154,238 @@ class DatabaseEmbedder:
     """
 
     def __init__(self, db: PostgresManager):
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        self.model = BertModel.from_pretrained("bert-base-uncased")
-        self.map_name_to_embeddings = {}
+        self.embedding_model = get_embedding_model()
+        # embeddings differ per backend so each gets its own store
+        self.embedding_store = embedding_store.get_embedding_store(
+            self.embedding_model.name
+        )
         self.map_name_to_table_def = {}
+        # columns with key flags, known when tables come from a schema snapshot
+        self.map_name_to_columns: Dict[str, List[TableColumn]] = {}
+        # row i of table_embeddings is the embedding of table_names[i]
+        # (the matrix stays empty once the hnsw index serves the search)
+        self.table_names: List[str] = []
+        self.map_name_to_index: Dict[str, int] = {}
+        # sized on the first add_tables so the model doesn't have to load here
+        self.table_embeddings = np.zeros((0, 0), dtype=np.float32)
+        # unit length copy of table_embeddings used for similarity search
+        self.normalized_table_embeddings = self.table_embeddings.copy()
+        self.ann_index = None
+        # the prompt is embedded once and reused for table and column scoring
+        self.last_query = None
+        self.last_query_embedding = None
+        # table and column name tokens for word matching
+        self.token_index = TokenIndex()
+        # table names, column names and comments for keyword retrieval
+        self.bm25_index = retrieval.BM25Index()
         self.db = db
 
-    def get_similar_table_defs_for_prompt(self, prompt: str, n_similar=5, n_foreign=0):
-        map_table_name_to_table_def = self.db.get_table_definition_map_for_embeddings()
-        for name, table_def in map_table_name_to_table_def.items():
-            self.add_table(name, table_def)
-
-        similar_tables = self.get_similar_tables(prompt, n=n_similar)
+    def get_similar_table_defs_for_prompt(
+        self,
+        prompt: str,
+        n_similar=5,
+        n_foreign=0,
+        token_budget=context_builder.TABLE_DEFINITIONS_TOKEN_BUDGET,
+    ):
+        self.add_schema_snapshot(self.db.get_schema_snapshot())
 
-        table_definitions = self.get_table_definitions_from_names(similar_tables)
+        similar_tables = self.get_similar_tables_with_scores(prompt, n=n_similar)
 
         if n_foreign > 0:
-            foreign_table_names = self.db.get_foreign_tables(similar_tables, n=3)
+            graph = self.db.get_foreign_key_graph()
+            similar_table_names = [table_name for table_name, _ in similar_tables]
 
-            table_definitions = self.get_table_definitions_from_names(
-                foreign_table_names + similar_tables
+            # tables needed to join the similar ones rank with the least similar table
+            join_score = min((score for _, score in similar_tables), default=0.0)
+            join_table_names = graph.get_join_path_tables(similar_table_names)
+            similar_tables += [
+                (table_name, join_score) for table_name in join_table_names
+            ]
+
+            # related tables only get the budget left over by the similar ones
+            foreign_table_names = graph.get_related_tables(
+                similar_table_names + join_table_names, n=n_foreign
             )
+            similar_tables += [(table_name, 0.0) for table_name in foreign_table_names]
 
-        return table_definitions
+        context = self.build_table_definitions_context(
+            similar_tables, prompt, token_budget
+        )
+        print(context_builder.describe(context))
+
+        return context.table_definitions
+
+    def add_schema_snapshot(self, snapshot: SchemaSnapshot):
+        """
+        Add every table of a schema snapshot, with its columns and comments.
+        """
+        self.add_tables(
+            snapshot.table_definitions,
+            {
+                table_name: retrieval.make_table_document_from_columns(
+                    table_name, columns, snapshot.table_comments.get(table_name)
+                )
+                for table_name, columns in snapshot.table_columns.items()
+            },
+        )
+        self.map_name_to_columns.update(snapshot.table_columns)
 
     def add_table(self, table_name: str, text_representation: str):
         """
         Add a table to the database embedder.
         Map the table name to its embedding and text representation.
         """
-        self.map_name_to_embeddings[table_name] = self.compute_embeddings(
-            text_representation
+        self.add_tables({table_name: text_representation})
+
+    def add_tables(
+        self,
+        map_table_name_to_table_def: Dict[str, str],
+        map_table_name_to_document: Optional[Dict[str, str]] = None,
+    ):
+        """
+        Add many tables to the database embedder, embedding them in batches.
+        Tables that were already added are re-embedded in place.
+
+        Embeddings are persisted by content hash, so only new or changed
+        table definitions are run through the model.
+
+        map_table_name_to_document is the text keyword retrieval indexes per table
+        (names and comments), built from the definitions when not given.
+
+        Once the hnsw index serves the search (EMBEDDING_SEARCH=hnsw, ANN_MIN_TABLES reached)
+        no exact matrix is kept and only tables the index lacks are read from the store.
+        """
+        table_names = list(map_table_name_to_table_def.keys())
+        table_defs = list(map_table_name_to_table_def.values())
+
+        self.map_name_to_table_def.update(map_table_name_to_table_def)
+        self.token_index.add_tables(map_table_name_to_table_def)
+
+        if map_table_name_to_document is None:
+            map_table_name_to_document = {
+                table_name: retrieval.make_table_document_from_definition(
+                    table_name, table_def
+                )
+                for table_name, table_def in map_table_name_to_table_def.items()
+            }
+        self.bm25_index.add_documents(map_table_name_to_document)
+
+        if EMBEDDING_SEARCH != "hnsw":
+            self.set_embeddings(
+                table_names,
+                self.embedding_store.get_embeddings(
+                    table_names, table_defs, self.compute_embeddings_batch
+                ),
+            )
+            return
+
+        new_names = [name for name in table_names if name not in self.map_name_to_index]
+        if len(self.table_names) + len(new_names) < ANN_MIN_TABLES:
+            # small schema - keep the exact matrix, the index is still kept current
+            embeddings = self.embedding_store.get_embeddings(
+                table_names, table_defs, self.compute_embeddings_batch
+            )
+            self.set_embeddings(table_names, embeddings)
+            self.upsert_ann_index(
+                table_names,
+                [embedding_store.content_hash(table_def) for table_def in table_defs],
+                embeddings,
+            )
+            return
+
+        # the index answers every search from here on - drop the exact matrix and
+        # only pull embeddings of tables the index doesn't have (or has stale)
+        self.table_embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.normalized_table_embeddings = self.table_embeddings.copy()
+        for table_name in new_names:
+            self.map_name_to_index[table_name] = len(self.table_names)
+            self.table_names.append(table_name)
+
+        hashes = [embedding_store.content_hash(table_def) for table_def in table_defs]
+        rows = list(range(len(table_names)))
+        if self.get_ann_index() is not None:
+            rows = self.ann_index.get_stale_rows(table_names, hashes)
+        if rows:
+            self.upsert_ann_index(
+                [table_names[row] for row in rows],
+                [hashes[row] for row in rows],
+                self.embedding_store.get_embeddings(
+                    [table_names[row] for row in rows],
+                    [table_defs[row] for row in rows],
+                    self.compute_embeddings_batch,
+                ),
+            )
+
+    def upsert_ann_index(
+        self, table_names: List[str], hashes: List[str], embeddings: np.ndarray
+    ):
+        self.get_ann_index(embeddings.shape[1]).upsert(
+            table_names, hashes, normalize_rows(embeddings)
         )
 
-        self.map_name_to_table_def[table_name] = text_representation
+    def get_ann_index(self, dim: Optional[int] = None) -> Optional[HnswTableIndex]:
+        """
+        Get the process wide approximate nearest neighbour index for this database.
+        None while the dimension is unknown - ie. nothing has been embedded with this model yet.
+        """
+        if self.ann_index is None:
+            dim = dim or self.embedding_store.dim
+            if not dim:
+                return None
+            name = self.embedding_model.name
+            if self.db is not None:
+                name += "-" + self.db.get_database_identity()
+            self.ann_index = ann_index.get_ann_index(name, dim)
+        return self.ann_index
+
+    def set_embeddings(self, table_names: List[str], embeddings: np.ndarray):
+        """
+        Write embeddings into the table matrix - overwriting known tables, appending new ones.
+        """
+        new_names = []
+        new_rows = []
+        normalized_embeddings = normalize_rows(embeddings)
+
+        for row, table_name in enumerate(table_names):
+            index = self.map_name_to_index.get(table_name)
+            if index is None:
+                new_names.append(table_name)
+                new_rows.append(row)
+            else:
+                self.table_embeddings[index] = embeddings[row]
+                self.normalized_table_embeddings[index] = normalized_embeddings[row]
+
+        if not new_names:
+            return
+
+        if not self.table_names:
+            self.table_embeddings = embeddings[new_rows]
+            self.normalized_table_embeddings = normalized_embeddings[new_rows]
+        else:
+            self.table_embeddings = np.concatenate(
+                [self.table_embeddings, embeddings[new_rows]]
+            )
+            self.normalized_table_embeddings = np.concatenate(
+                [self.normalized_table_embeddings, normalized_embeddings[new_rows]]
+            )
+
+        for table_name in new_names:
+            self.map_name_to_index[table_name] = len(self.table_names)
+            self.table_names.append(table_name)
 
     def compute_embeddings(self, text):
         """
-        Compute embeddings for a given text using the BERT model.
+        Compute embeddings for a given text.
         """
-        inputs = self.tokenizer(
-            text, return_tensors="pt", truncation=True, padding=True, max_length=512
-        )
-        outputs = self.model(**inputs)
-        return outputs["pooler_output"].detach().numpy()
+        return self.compute_embeddings_batch([text])
+
+    def compute_embeddings_batch(
+        self, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE
+    ) -> np.ndarray:
+        """
+        Compute embeddings for many texts with the configured EMBEDDING_BACKEND.
+        """
+        return self.embedding_model.embed(texts, batch_size)
 
     def get_similar_tables_via_embeddings(self, query, n=3):
         """
@@ -67,40 +398,104 @@ class DatabaseEmbedder:
         Returns:
         - list: Top 'n' table names ranked by their similarity to the query.
         """
-        # Compute the embedding for the user's query
-        query_embedding = self.compute_embeddings(query)
-        # Calculate cosine similarity between the query and all tables
-        similarities = {
-            table: cosine_similarity(query_embedding, emb)[0][0]
-            for table, emb in self.map_name_to_embeddings.items()
-        }
-        # Rank tables based on their similarity scores and return top 'n'
-        return sorted(similarities, key=similarities.get, reverse=True)[:n]
+        if self.ann_index is not None and len(self.table_names) >= ANN_MIN_TABLES:
+            query_embedding = self.get_query_embedding(query)
+            # over-fetch - the index can still hold tables that were dropped since
+            hits = self.ann_index.query(query_embedding, 2 * n)
+            return [name for name, _ in hits if name in self.map_name_to_index][:n]
 
-    def get_similar_table_names_via_word_match(self, query: str):
+        scores = self.get_table_similarity_scores(query)
+        return [self.table_names[i] for i in top_k_indices(scores, n)]
+
+    def get_query_embedding(self, query: str) -> np.ndarray:
         """
-        if any word in our query is a table name, add the table to a list
+        Unit length embedding of the query, computed once per distinct query.
         """
+        if query != self.last_query:
+            query_embeddings = normalize_rows(self.compute_embeddings(query))
+            self.last_query_embedding = query_embeddings[0]
+            self.last_query = query
+        return self.last_query_embedding
 
-        tables = []
+    def get_table_similarity_scores(self, query: str) -> np.ndarray:
+        """
+        Cosine similarity between the query and every table, aligned with table_names.
+        One matrix-vector product against the pre-normalized table embeddings.
+        """
+        if not self.table_names:
+            return np.empty(0, dtype=np.float32)
+        return self.normalized_table_embeddings @ self.get_query_embedding(query)
+
+    def get_column_similarity_scores(
+        self, table_name: str, columns: List[TableColumn], query: str
+    ) -> np.ndarray:
+        """
+        Cosine similarity between the query and every column of a table, aligned with columns.
+        Column embeddings live in the same content hash store as table embeddings.
+        """
+        embeddings = self.embedding_store.get_embeddings(
+            [f"{table_name}.{column.name}" for column in columns],
+            [column_pruning.make_column_text(table_name, column) for column in columns],
+            self.compute_embeddings_batch,
+        )
+        return normalize_rows(embeddings) @ self.get_query_embedding(query)
+
+    def get_similar_table_names_via_word_match(self, query: str):
+        """
+        if every word of a table name is in our query, add the table to a list
 
-        for table_name in self.map_name_to_table_def.keys():
-            if table_name.lower() in query.lower():
-                tables.append(table_name)
+        Table names and the query are both split on snake_case and camelCase
+        and stemmed, so 'order items' matches 'OrderItems' and 'order_items'.
+        """
+        return self.token_index.match_table_names(query)
 
-        return tables
+    def get_word_match_scores(self, query: str) -> Dict[str, float]:
+        """
+        Word match score of every table sharing a table or column name token with the query.
+        """
+        return self.token_index.get_scores(query)
 
     def get_similar_tables(self, query: str, n=3):
         """
-        combines results from get_similar_tables_via_embeddings and get_similar_table_names_via_word_match
+        Hybrid retrieval: fuses the embedding ranking with the BM25 ranking
+        through reciprocal rank fusion, keeps the top 'n' fused tables,
+        then adds any table named in the query.
+
+        Returns a de-duplicated list of table names, best first.
+        """
+        return [
+            table_name
+            for table_name, _ in self.get_similar_tables_with_scores(query, n)
+        ]
+
+    def get_similar_tables_with_scores(
+        self, query: str, n=3
+    ) -> List[Tuple[str, float]]:
+        """
+        Same tables as get_similar_tables, as (table name, fused score).
+        Tables named in the query score as high as the best fused table.
         """
+        n_candidates = n * retrieval.RETRIEVAL_CANDIDATES
 
-        similar_tables_via_embeddings = self.get_similar_tables_via_embeddings(query, n)
-        similar_tables_via_word_match = self.get_similar_table_names_via_word_match(
-            query
+        fused = retrieval.reciprocal_rank_fusion(
+            [
+                self.get_similar_tables_via_embeddings(query, n_candidates),
+                self.bm25_index.rank(query, n_candidates),
+            ]
         )
+        map_name_to_score = dict(fused)
+        similar_tables = [
+            (table_name, map_name_to_score[table_name])
+            for table_name in retrieval.cut_off(fused, n)
+        ]
+
+        best_score = fused[0][1] if fused else 1.0
+        similar_table_names = {table_name for table_name, _ in similar_tables}
+        for table_name in self.get_similar_table_names_via_word_match(query):
+            if table_name not in similar_table_names:
+                similar_tables.append((table_name, best_score))
 
-        return similar_tables_via_embeddings + similar_tables_via_word_match
+        return similar_tables
 
     def get_table_definitions_from_names(self, table_names: list) -> str:
         """
@@ -110,3 +505,70 @@ class DatabaseEmbedder:
             self.map_name_to_table_def[table_name] for table_name in table_names
         ]
         return "\n\n".join(table_defs)
+
+    def get_pruned_table_definition(
+        self, table_name: str, query: str, n_columns=column_pruning.COLUMN_PRUNE_TOP_N
+    ) -> str:
+        """
+        Table definition for a query. Tables wider than COLUMN_PRUNE_MIN_COLUMNS are cut
+        down to their key columns, the columns named in the query and the 'n_columns'
+        columns most similar to it.
+        """
+        columns = self.map_name_to_columns.get(table_name)
+        if columns is None or len(columns) <= column_pruning.COLUMN_PRUNE_MIN_COLUMNS:
+            return self.map_name_to_table_def[table_name]
+
+        scores = self.get_column_similarity_scores(table_name, columns, query)
+        kept_columns = column_pruning.select_columns(columns, query, scores, n_columns)
+        return column_pruning.make_pruned_table_definition(
+            table_name, kept_columns, len(columns)
+        )
+
+    def get_short_table_definition(self, table_name: str, query: str) -> Optional[str]:
+        """
+        Table definition with only the key columns and the columns named in the query.
+        None when the table's columns aren't known.
+        """
+        columns = self.map_name_to_columns.get(table_name)
+        if columns is None:
+            return None
+
+        kept_columns = column_pruning.select_columns(columns, query, top_n=0)
+        return column_pruning.make_pruned_table_definition(
+            table_name, kept_columns, len(columns)
+        )
+
+    def get_pruned_table_definitions_from_names(
+        self, table_names: list, query: str, n_columns=column_pruning.COLUMN_PRUNE_TOP_N
+    ) -> str:
+        """
+        Given a list of table names, return their (pruned) table definitions for a query.
+        """
+        table_defs = [
+            self.get_pruned_table_definition(table_name, query, n_columns)
+            for table_name in table_names
+        ]
+        return "\n\n".join(table_defs)
+
+    def build_table_definitions_context(
+        self,
+        tables: List[Tuple[str, float]],
+        query: str,
+        token_budget=context_builder.TABLE_DEFINITIONS_TOKEN_BUDGET,
+    ) -> TableDefinitionsContext:
+        """
+        Pack the definitions of (table name, relevance score) pairs into a token budget,
+        shortening or dropping the least relevant tables when they don't fit.
+        """
+        return context_builder.build_table_definitions_context(
+            [
+                (
+                    table_name,
+                    score,
+                    self.get_pruned_table_definition(table_name, query),
+                    self.get_short_table_definition(table_name, query),
+                )
+                for table_name, score in tables
+            ],
+            token_budget,
+        )
@@ -0,0 +1,110 @@
+"""
+Purpose:
+    Remember the ids of OpenAI assistants, threads and files by name on local disk,
+    so Turbo4 only pages through the list endpoints on a miss.
+
+    Entries expire after OPENAI_ID_REGISTRY_TTL_SECONDS - objects changed outside this
+    process are picked up again after that. Turbo4 drops the entry of an object that was
+    deleted as soon as fetching it returns 404.
+    Each API key gets its own registry file since ids aren't shared between accounts.
+
+Layout:
+    CACHE_DIR/openai_ids/<api key hash>.json - kind -> name -> entry
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+CACHE_DIR = os.environ.get("CACHE_DIR", "./.cache")
+
+OPENAI_ID_REGISTRY_TTL_SECONDS = int(
+    os.environ.get("OPENAI_ID_REGISTRY_TTL_SECONDS", 24 * 60 * 60)
+)
+
+
+class IdRegistry:
+    """
+    Persistent kind -> name -> entry map. Every entry has the object's 'id' and
+    'updated_at', plus whatever fields its kind needs (model, content hash, ...). Thread safe.
+    """
+
+    def __init__(self, fname: str, ttl_seconds: int = OPENAI_ID_REGISTRY_TTL_SECONDS):
+        self.fname = fname
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.fname, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.fname) or ".", exist_ok=True)
+
+        # write to a temp file first so concurrent readers never see a partial registry
+        tmp_fname = f"{self.fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_fname, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_fname, self.fname)
+
+    def get(
+        self, kind: str, name: str, fresh_only: bool = True
+    ) -> Optional[Dict[str, Any]]:
+        """
+        The entry registered for a name, None if there is none or it expired.
+        fresh_only=False also returns expired entries, ie. to carry fields over to a refreshed entry.
+        """
+        with self.lock:
+            entry = self.entries.get(kind, {}).get(name)
+
+        if entry is None:
+            return None
+        if fresh_only and time.time() - entry["updated_at"] > self.ttl_seconds:
+            return None
+
+        return entry
+
+    def put(self, kind: str, name: str, id: str, **fields):
+        self.put_many(kind, {name: dict(fields, id=id)})
+
+    def put_many(self, kind: str, map_name_to_entry: Dict[str, Dict[str, Any]]):
+        """
+        Register many entries of a kind with a single write.
+        """
+        now = time.time()
+        with self.lock:
+            entries = self.entries.setdefault(kind, {})
+            for name, entry in map_name_to_entry.items():
+                entries[name] = dict(entry, updated_at=now)
+            self.save()
+
+    def delete(self, kind: str, name: str):
+        with self.lock:
+            if self.entries.get(kind, {}).pop(name, None) is not None:
+                self.save()
+
+
+_registries: Dict[str, IdRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(api_key: Optional[str]) -> IdRegistry:
+    """
+    Get the shared registry of an API key.
+    """
+    key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+    fname = os.path.join(CACHE_DIR, "openai_ids", f"{key_hash}.json")
+
+    with _registries_lock:
+        if fname not in _registries:
+            _registries[fname] = IdRegistry(fname)
+        return _registries[fname]
@@ -4,14 +4,21 @@ Purpose:
     Provide supporting prompt engineering functions.
 """
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import json
 import sys
+import threading
+import weakref
 from dotenv import load_dotenv
 import os
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Tuple
+import httpx
 import openai
-import tiktoken
 
+from postgres_da_ai_agent.modules import usage
+from postgres_da_ai_agent.modules.tokens import count_tokens
 from postgres_da_ai_agent.types import TurboTool
 
 # load .env file
@@ -46,6 +53,44 @@ def response_parser(response: Dict[str, Any]):
     return safe_get(response, "choices.0.message.content")
 
 
+# tool calls of one model step run at the same time on at most this many threads
+TOOL_CALL_MAX_WORKERS = int(os.environ.get("TOOL_CALL_MAX_WORKERS", 4))
+
+_tool_call_executor = None
+_tool_call_executor_lock = threading.Lock()
+
+
+def get_tool_call_executor() -> ThreadPoolExecutor:
+    global _tool_call_executor
+    with _tool_call_executor_lock:
+        if _tool_call_executor is None:
+            _tool_call_executor = ThreadPoolExecutor(
+                max_workers=TOOL_CALL_MAX_WORKERS, thread_name_prefix="tool-call"
+            )
+        return _tool_call_executor
+
+
+def run_tool_calls(calls: List[Tuple[Callable, Dict[str, Any]]]) -> List[Any]:
+    """
+    Run (function, arguments) tool calls concurrently and return their outputs in call order,
+    so a step costs its slowest call instead of the sum of them. A single call runs inline.
+
+    Each call runs in a copy of the caller's context, so usage attribution carries over.
+    The first failing call's exception is raised once every call has finished.
+    """
+    if len(calls) <= 1:
+        return [function(**arguments) for function, arguments in calls]
+
+    executor = get_tool_call_executor()
+    futures = [
+        executor.submit(contextvars.copy_context().run, function, **arguments)
+        for function, arguments in calls
+    ]
+    for future in futures:
+        future.exception()
+    return [future.result() for future in futures]
+
+
 # ------------------ content generators ------------------
 
 
@@ -80,6 +125,7 @@ Example bash command:
             },
         ],
     )
+    usage.ledger.record_usage(model, response.usage)
 
     return response_parser(response.model_dump())
 
@@ -115,6 +161,7 @@ def prompt_func(
     response = openai.chat.completions.create(
         model=model, messages=messages, tools=tools, tool_choice=tool_choice
     )
+    usage.ledger.record_usage(model, response.usage)
 
     response_message = response.choices[0].message
     tool_calls = response_message.tool_calls
@@ -124,24 +171,32 @@ def prompt_func(
     if tool_calls:
         messages.append(response_message)
 
+        matched_tool_calls = []
         for tool_call in tool_calls:
             for turbo_tool in turbo_tools:
                 if tool_call.function.name == turbo_tool.name:
-                    function_response = turbo_tool.function(
-                        **json.loads(tool_call.function.arguments)
-                    )
-
-                    func_responses.append(function_response)
-
-                    message_to_append = {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": turbo_tool.name,
-                        "content": function_response,
-                    }
-                    messages.append(message_to_append)
+                    matched_tool_calls.append((tool_call, turbo_tool))
                     break
 
+        # the calls of one step are independent - run them at the same time
+        func_responses = run_tool_calls(
+            [
+                (turbo_tool.function, json.loads(tool_call.function.arguments))
+                for tool_call, turbo_tool in matched_tool_calls
+            ]
+        )
+
+        for (tool_call, turbo_tool), function_response in zip(
+            matched_tool_calls, func_responses
+        ):
+            message_to_append = {
+                "tool_call_id": tool_call.id,
+                "role": "tool",
+                "name": turbo_tool.name,
+                "content": function_response,
+            }
+            messages.append(message_to_append)
+
     return func_responses
 
 
@@ -184,6 +239,166 @@ Example bash command:
         ],
         response_format={"type": "json_object"},
     )
+    usage.ledger.record_usage(model, response.usage)
+
+    return response_parser(response.model_dump())
+
+
+# ------------------ async content generators ------------------
+
+# max llm requests in flight per event loop, the rest wait their turn
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+# idle connections kept open to the api between requests
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 8))
+
+# event loop -> (async client, concurrency limiter) - both are bound to the loop they're used on
+_async_clients = weakref.WeakKeyDictionary()
+
+# background loop sync code runs coroutines on, see run_concurrently()
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def get_async_client() -> Tuple[openai.AsyncOpenAI, asyncio.Semaphore]:
+    """
+    Pooled keep-alive AsyncOpenAI client and concurrency limiter of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONCURRENCY,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(600.0, connect=5.0),
+        )
+        _async_clients[loop] = (
+            openai.AsyncOpenAI(api_key=openai.api_key, http_client=http_client),
+            asyncio.Semaphore(LLM_MAX_CONCURRENCY),
+        )
+    return _async_clients[loop]
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Process wide event loop running on a daemon thread, started on first use.
+    Sync callers share it so they also share its client and connection pool.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_event_loop.run_forever, name="llm-event-loop", daemon=True
+            ).start()
+        return _event_loop
+
+
+async def _gather(*coroutines):
+    return await asyncio.gather(*coroutines)
+
+
+def run_concurrently(*coroutines) -> List[Any]:
+    """
+    Run independent llm coroutines at the same time from sync code, results in order.
+    The caller's usage attribution carries over to the coroutines.
+
+    Example:
+        sql_response, insights = llm.run_concurrently(
+            llm.aprompt(sql_prompt),
+            llm.aprompt_json_response(insights_prompt),
+        )
+    """
+    return asyncio.run_coroutine_threadsafe(
+        _gather(*coroutines), get_event_loop()
+    ).result()
+
+
+async def _acreate_chat_completion(**kwargs):
+    client, semaphore = get_async_client()
+    async with semaphore:
+        response = await client.chat.completions.create(**kwargs)
+    usage.ledger.record_usage(kwargs["model"], response.usage)
+    return response
+
+
+async def aprompt(
+    prompt: str,
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+) -> str:
+    """
+    Async prompt(). Shares the event loop's pooled client and concurrency limit.
+    """
+    response = await _acreate_chat_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": prompt},
+        ],
+    )
+
+    return response_parser(response.model_dump())
+
+
+async def aprompt_func(
+    prompt: str,
+    turbo_tools: List[TurboTool],
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+) -> str:
+    """
+    Async prompt_func(). The tool functions are blocking, so they run on a worker thread.
+    """
+    messages = [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": prompt},
+    ]
+    tools = [turbo_tool.config for turbo_tool in turbo_tools]
+
+    tool_choice = (
+        "auto"
+        if len(turbo_tools) > 1
+        else {"type": "function", "function": {"name": turbo_tools[0].name}}
+    )
+
+    response = await _acreate_chat_completion(
+        model=model, messages=messages, tools=tools, tool_choice=tool_choice
+    )
+
+    tool_calls = response.choices[0].message.tool_calls or []
+    map_name_to_turbo_tool = {turbo_tool.name: turbo_tool for turbo_tool in turbo_tools}
+
+    func_responses = []
+    for tool_call in tool_calls:
+        turbo_tool = map_name_to_turbo_tool.get(tool_call.function.name)
+        if turbo_tool is None:
+            continue
+        func_responses.append(
+            await asyncio.to_thread(
+                turbo_tool.function, **json.loads(tool_call.function.arguments)
+            )
+        )
+
+    return func_responses
+
+
+async def aprompt_json_response(
+    prompt: str,
+    model: str = "gpt-4-1106-preview",
+    instructions: str = "You are a helpful assistant.",
+) -> str:
+    """
+    Async prompt_json_response().
+    """
+    response = await _acreate_chat_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": prompt},
+        ],
+        response_format={"type": "json_object"},
+    )
 
     return response_parser(response.model_dump())
 
@@ -206,14 +421,6 @@ def add_cap_ref(
     return new_prompt
 
 
-def count_tokens(text: str):
-    """
-    Count the number of tokens in a string.
-    """
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
-
-
 map_model_to_cost_per_1k_tokens = {
     "gpt-4": 0.075,  # ($0.03 Input Tokens + $0.06 Output Tokens) / 2
     "gpt-4-1106-preview": 0.02,  # ($0.01 Input Tokens + $0.03 Output Tokens) / 2
@@ -226,14 +433,21 @@ def estimate_price_and_tokens(text, model="gpt-4"):
     """
     Conservative estimate the price and tokens for a given text.
     """
+    tokens = count_tokens(text, model)
+
+    return estimate_price(tokens, model), tokens
+
+
+def estimate_price(tokens: int, model="gpt-4"):
+    """
+    Conservative estimate the price of a token count.
+    """
     # round up to the output tokens
     COST_PER_1k_TOKENS = map_model_to_cost_per_1k_tokens[model]
 
-    tokens = count_tokens(text)
-
     estimated_cost = (tokens / 1000) * COST_PER_1k_TOKENS
 
     # round
     estimated_cost = round(estimated_cost, 2)
 
-    return estimated_cost, tokens
+    return estimated_cost
@@ -28,6 +28,9 @@ class Orchestrator:
         # List of raw messages - partially redundant due to self.chats
         self.messages = []
 
+        # Running token count of self.messages, updated as messages are added
+        self.tokens = 0
+
         # Agent instruments - state and functions that agents can use
         self.instruments = instruments
 
@@ -111,31 +114,39 @@ class Orchestrator:
         """
         self.messages.append(message)
 
-    def get_message_as_str(self):
+        message_as_str = self.message_as_str(message)
+        if message_as_str:
+            self.tokens += llm.count_tokens(message_as_str)
+
+    @staticmethod
+    def message_as_str(message) -> str:
         """
-        Get all messages as a string
+        Get the text of a single message - its content or function call
         """
+        if message is None:
+            return ""
 
-        messages_as_str = ""
-
-        for message in self.messages:
-            if message is None:
-                continue
+        if isinstance(message, dict):
+            content_from_dict = message.get("content", None)
+            func_call_from_dict = message.get("function_call", None)
+            content = content_from_dict or func_call_from_dict
+            if not content:
+                return ""
+            return str(content)
 
-            if isinstance(message, dict):
-                content_from_dict = message.get("content", None)
-                func_call_from_dict = message.get("function_call", None)
-                content = content_from_dict or func_call_from_dict
-                if not content:
-                    continue
-                messages_as_str += str(content)
-            else:
-                messages_as_str += str(message)
+        return str(message)
 
-        return messages_as_str
+    def get_message_as_str(self):
+        """
+        Get all messages as a string
+        """
+        return "".join(self.message_as_str(message) for message in self.messages)
 
     def get_cost_and_tokens(self):
-        return llm.estimate_price_and_tokens(self.get_message_as_str())
+        """
+        Cost and tokens of the conversation so far, from the running tally
+        """
+        return llm.estimate_price(self.tokens), self.tokens
 
     def has_functions(self, agent: autogen.ConversableAgent):
         return len(agent._function_map) > 0
@@ -0,0 +1,245 @@
+"""
+Purpose:
+    Cache generated SQL by prompt so repeated questions skip the LLM and go straight to run_sql.
+
+    Entries are keyed by the normalized prompt and a hash of the table definitions, so DDL
+    that changes a definition invalidates them - TRUNCATE or VACUUM FULL don't. Lookups try an exact match first, then - only if
+    RESPONSE_CACHE_SIMILARITY_THRESHOLD is set - the most similar cached prompt embedding above it.
+    Entries expire after RESPONSE_CACHE_TTL_SECONDS and the least recently used
+    are evicted past RESPONSE_CACHE_MAX_ENTRIES.
+
+Layout:
+    CACHE_DIR/responses.sqlite3
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+CACHE_DIR = os.environ.get("CACHE_DIR", "./.cache")
+
+RESPONSE_CACHE_TTL_SECONDS = int(
+    os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60)
+)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000))
+# cosine similarity a cached prompt needs to be served for a differently worded one.
+# Off by default - the table embeddings rate prompts that want different SQL
+# ('orders in 2022' / 'orders in 2023') as near identical, so calibrate it on your own prompts.
+RESPONSE_CACHE_SIMILARITY_THRESHOLD: Optional[float] = (
+    float(os.environ["RESPONSE_CACHE_SIMILARITY_THRESHOLD"])
+    if os.environ.get("RESPONSE_CACHE_SIMILARITY_THRESHOLD")
+    else None
+)
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Lowercase, collapse whitespace and drop trailing punctuation.
+    Operators and numbers are kept - 'price > 10' and 'price < 10' are different questions.
+    """
+    return WHITESPACE.sub(" ", prompt.lower()).strip().rstrip(".?! ")
+
+
+def make_key(prompt: str, schema_fingerprint: str) -> str:
+    return hashlib.sha256(
+        f"{schema_fingerprint}\n{normalize_prompt(prompt)}".encode()
+    ).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite backed prompt -> SQL cache with an exact and an optional similarity tier. Thread safe.
+    """
+
+    def __init__(
+        self,
+        fname: str = os.path.join(CACHE_DIR, "responses.sqlite3"),
+        ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        similarity_threshold: Optional[float] = RESPONSE_CACHE_SIMILARITY_THRESHOLD,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(fname) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                schema_fingerprint TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                sql TEXT NOT NULL,
+                embedding BLOB,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+            """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_schema_fingerprint ON responses (schema_fingerprint)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used_at ON responses (last_used_at)"
+        )
+        self.conn.commit()
+
+    def get(
+        self,
+        prompt: str,
+        schema_fingerprint: str,
+        embed_prompt: Optional[Callable[[], Optional[np.ndarray]]] = None,
+    ) -> Optional[Tuple[str, str]]:
+        """
+        (key, sql) of the entry answering the prompt, None on a miss.
+        The key is the matched entry's - a similar hit isn't stored under the prompt's own key.
+
+        embed_prompt is only called after an exact miss with a similarity threshold set,
+        so exact hits and the default exact-only cache never embed the prompt.
+        """
+        now = time.time()
+        min_created_at = now - self.ttl_seconds
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT key, sql FROM responses WHERE key = ? AND created_at >= ?",
+                (make_key(prompt, schema_fingerprint), min_created_at),
+            ).fetchone()
+
+        if (
+            row is None
+            and embed_prompt is not None
+            and self.similarity_threshold is not None
+        ):
+            # embedding is the slow part - other lookups don't wait on it
+            embedding = embed_prompt()
+            if embedding is not None:
+                with self.lock:
+                    row = self.get_most_similar(
+                        schema_fingerprint, embedding, min_created_at
+                    )
+
+        if row is None:
+            return None
+
+        key, sql = row
+        with self.lock:
+            self.conn.execute(
+                "UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key)
+            )
+            self.conn.commit()
+
+        return key, sql
+
+    def get_most_similar(
+        self, schema_fingerprint: str, embedding: np.ndarray, min_created_at: float
+    ):
+        """
+        (key, sql) of the fresh entry most similar to the embedding, if it clears the threshold.
+        """
+        rows = self.conn.execute(
+            """
+            SELECT key, sql, embedding FROM responses
+            WHERE schema_fingerprint = ? AND created_at >= ? AND embedding IS NOT NULL
+            """,
+            (schema_fingerprint, min_created_at),
+        ).fetchall()
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+
+        # entries embedded by a model of another size can't be compared
+        rows = [row for row in rows if len(row[2]) == query.nbytes]
+        if not rows:
+            return None
+
+        # stored embeddings are unit length
+        scores = (
+            np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows]) @ query
+        )
+
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+
+        print(f"response_cache: similar prompt hit ({scores[best]:.3f})")
+        return rows[best][0], rows[best][1]
+
+    def put(
+        self,
+        prompt: str,
+        schema_fingerprint: str,
+        sql: str,
+        embedding: Optional[np.ndarray] = None,
+    ):
+        """
+        Cache the SQL answering a prompt, then drop expired and least recently used entries.
+        """
+        now = time.time()
+
+        embedding_blob = None
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding_blob = (embedding / (np.linalg.norm(embedding) or 1)).tobytes()
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    make_key(prompt, schema_fingerprint),
+                    schema_fingerprint,
+                    normalize_prompt(prompt),
+                    sql,
+                    embedding_blob,
+                    now,
+                    now,
+                ),
+            )
+            self.evict(now)
+            self.conn.commit()
+
+    def delete(self, key: str):
+        """
+        Forget an entry by the key get() returned, ie. when its cached SQL stopped working.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def evict(self, now: float):
+        self.conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        self.conn.execute(
+            """
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM responses ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+
+
+_caches: Dict[str, ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(
+    fname: str = os.path.join(CACHE_DIR, "responses.sqlite3")
+) -> ResponseCache:
+    """
+    Get the shared response cache for a cache file.
+    """
+    with _caches_lock:
+        if fname not in _caches:
+            _caches[fname] = ResponseCache(fname)
+        return _caches[fname]
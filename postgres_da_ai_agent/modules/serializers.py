@@ -0,0 +1,293 @@
+"""
+Purpose:
+    Serialize run_sql result batches to files.
+    Values are converted one column at a time - the converter is picked once per column
+    from its first non-null value instead of once per value.
+
+Formats:
+    json      - indented list of row objects (the original run_sql output)
+    ndjson    - one compact row object per line
+    columnar  - compact {"columns": [...], "rows": [[...], ...]} - column names only once
+    arrow     - Arrow IPC stream (requires pyarrow)
+    parquet   - Parquet file, one row group per batch (requires pyarrow)
+"""
+
+from datetime import date, datetime, time
+from decimal import Decimal
+import json
+import os
+from typing import Callable, Dict, List, Optional, Type
+import uuid
+
+# rows the arrow and parquet formats scan for the type of all-null columns before writing
+ARROW_SCHEMA_SCAN_ROWS = int(os.environ.get("ARROW_SCHEMA_SCAN_ROWS", 10000))
+
+# ------------------ column conversion ------------------
+
+
+def to_json_value(value):
+    """
+    Fallback for values json can't encode natively.
+    """
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def get_column_converter(column: tuple) -> Optional[Callable]:
+    """
+    Pick a converter for a column based on its first non-null value.
+    Returns None if the column is already json encodable.
+    """
+    for value in column:
+        if value is None:
+            continue
+        if isinstance(value, (datetime, date, time)):
+            return lambda v: v.isoformat()
+        if isinstance(value, (Decimal, uuid.UUID)):
+            return str
+        if isinstance(value, (str, int, float, bool, list, dict)):
+            return None
+        return to_json_value
+    return None
+
+
+def convert_columns(rows: List[tuple]) -> List[list]:
+    """
+    Transpose a batch of rows into columns and convert each column to json values.
+    """
+    converted = []
+    for column in zip(*rows):
+        converter = get_column_converter(column)
+        if converter is None:
+            converted.append(list(column))
+        else:
+            converted.append([None if v is None else converter(v) for v in column])
+    return converted
+
+
+# ------------------ serializers ------------------
+
+
+class ResultSerializer:
+    """
+    Base class for writing run_sql result batches to an open file
+    """
+
+    extension = ".json"
+    binary = False
+
+    def __init__(self, f):
+        self.f = f
+        self.row_count = 0
+
+    def write_batch(self, columns: List[str], rows: List[tuple]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonSerializer(ResultSerializer):
+    """
+    Indented list of row objects - the original run_sql format
+    """
+
+    def write_batch(self, columns: List[str], rows: List[tuple]):
+        for row in zip(*convert_columns(rows)):
+            row_json = json.dumps(
+                dict(zip(columns, row)), indent=4, default=to_json_value
+            )
+            self.f.write(",\n    " if self.row_count else "[\n    ")
+            self.f.write(row_json.replace("\n", "\n    "))
+            self.row_count += 1
+
+    def close(self):
+        self.f.write("\n]" if self.row_count else "[]")
+
+
+class NdjsonSerializer(ResultSerializer):
+    """
+    One compact row object per line
+    """
+
+    extension = ".ndjson"
+
+    def write_batch(self, columns: List[str], rows: List[tuple]):
+        lines = [
+            json.dumps(
+                dict(zip(columns, row)), separators=(",", ":"), default=to_json_value
+            )
+            for row in zip(*convert_columns(rows))
+        ]
+        if not lines:
+            return
+        self.f.write("\n".join(lines) + "\n")
+        self.row_count += len(lines)
+
+
+class ColumnarJsonSerializer(ResultSerializer):
+    """
+    Compact json with the column names written once followed by row arrays
+    """
+
+    def __init__(self, f):
+        super().__init__(f)
+        self.columns = None
+
+    def write_batch(self, columns: List[str], rows: List[tuple]):
+        if self.columns is None:
+            self.columns = columns
+            self.f.write(
+                '{"columns":' + json.dumps(columns, separators=(",", ":")) + ',"rows":['
+            )
+
+        for row in zip(*convert_columns(rows)):
+            if self.row_count:
+                self.f.write(",")
+            self.f.write(json.dumps(row, separators=(",", ":"), default=to_json_value))
+            self.row_count += 1
+
+    def close(self):
+        if self.columns is None:
+            self.f.write('{"columns":[],"rows":[')
+        self.f.write("]}")
+
+
+class ArrowSerializer(ResultSerializer):
+    """
+    Arrow IPC stream. Batches are held back until every column had a non-null value
+    (or ARROW_SCHEMA_SCAN_ROWS rows were seen) and the schema is inferred from them.
+    Columns that are still all null become strings.
+    Decimals are written as float64 and uuids as strings.
+    """
+
+    extension = ".arrow"
+    binary = True
+
+    def __init__(self, f):
+        super().__init__(f)
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(
+                "pyarrow is required for the arrow and parquet result formats: pip install pyarrow"
+            )
+        self.pa = pyarrow
+        self.columns: List[str] = []
+        self.schema = None
+        self.writer = None
+        # batches waiting for the schema, and which of their columns had a non-null value
+        self.pending: List[List[list]] = []
+        self.pending_rows = 0
+        self.typed: List[bool] = []
+        # columns typed as string only because they were all null, later values are str()'d
+        self.null_columns: List[int] = []
+
+    def to_arrow_column(self, column: tuple):
+        for value in column:
+            if value is None:
+                continue
+            if isinstance(value, Decimal):
+                return [None if v is None else float(v) for v in column]
+            if isinstance(value, uuid.UUID):
+                return [None if v is None else str(v) for v in column]
+            break
+        return list(column)
+
+    def make_writer(self, schema):
+        return self.pa.ipc.new_stream(self.f, schema)
+
+    def write_batch(self, columns: List[str], rows: List[tuple]):
+        if rows:
+            arrow_columns = [self.to_arrow_column(column) for column in zip(*rows)]
+        else:
+            arrow_columns = [[] for _ in columns]
+
+        if self.writer is not None:
+            self.write_arrays(arrow_columns)
+            return
+
+        self.columns = columns
+        self.typed = [
+            typed or any(v is not None for v in column)
+            for typed, column in zip(
+                self.typed or [False] * len(columns), arrow_columns
+            )
+        ]
+        self.pending.append(arrow_columns)
+        self.pending_rows += len(rows)
+
+        if all(self.typed) or self.pending_rows >= ARROW_SCHEMA_SCAN_ROWS:
+            self.open_writer()
+
+    def open_writer(self):
+        """
+        Infer the schema from the pending batches, then write them.
+        """
+        fields = []
+        for index, name in enumerate(self.columns):
+            values = [value for batch in self.pending for value in batch[index]]
+            array_type = self.pa.array(values).type
+            if self.pa.types.is_null(array_type):
+                array_type = self.pa.string()
+                self.null_columns.append(index)
+            fields.append(self.pa.field(name, array_type))
+
+        self.schema = self.pa.schema(fields)
+        self.writer = self.make_writer(self.schema)
+
+        pending, self.pending = self.pending, []
+        for arrow_columns in pending:
+            self.write_arrays(arrow_columns)
+
+    def write_arrays(self, arrow_columns: List[list]):
+        for index in self.null_columns:
+            arrow_columns[index] = [
+                None if v is None else str(v) for v in arrow_columns[index]
+            ]
+
+        arrays = [
+            self.pa.array(column, type=field.type)
+            for column, field in zip(arrow_columns, self.schema)
+        ]
+        batch = self.pa.record_batch(arrays, schema=self.schema)
+        if batch.num_rows:
+            self.writer.write_batch(batch)
+        self.row_count += batch.num_rows
+
+    def close(self):
+        # always open the writer so an empty result is still a valid file with a schema
+        if self.writer is None:
+            self.open_writer()
+        self.writer.close()
+
+
+class ParquetSerializer(ArrowSerializer):
+    """
+    Parquet file with one row group per batch
+    """
+
+    extension = ".parquet"
+
+    def make_writer(self, schema):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.ParquetWriter(self.f, schema)
+
+
+SERIALIZERS: Dict[str, Type[ResultSerializer]] = {
+    "json": JsonSerializer,
+    "ndjson": NdjsonSerializer,
+    "columnar": ColumnarJsonSerializer,
+    "arrow": ArrowSerializer,
+    "parquet": ParquetSerializer,
+}
+
+
+def get_serializer(results_format: str) -> Type[ResultSerializer]:
+    if results_format not in SERIALIZERS:
+        raise ValueError(
+            f"Unknown results format '{results_format}'. Use one of {list(SERIALIZERS)}"
+        )
+    return SERIALIZERS[results_format]
@@ -0,0 +1,165 @@
+"""
+Purpose:
+    Inverted index from table and column name tokens to tables, used to match
+    the words of a prompt against the schema.
+
+    Identifiers and prompts go through the same tokenizer - snake_case and
+    camelCase are split, everything is lowercased and plurals are stemmed - so
+    'OrderItems', 'order_items' and 'order items' all produce 'order', 'item'.
+    Matching looks up each distinct prompt token once, so it is linear in the
+    prompt length instead of in the number of tables.
+"""
+
+import math
+import re
+from typing import Dict, List, Set, Tuple
+
+# fooBar -> foo Bar, HTTPServer -> HTTP Server
+CAMEL_CASE_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+TOKEN = re.compile(r"[a-z0-9]+")
+
+# a matching column token is worth this much of a fully matched table name
+COLUMN_MATCH_WEIGHT = 0.25
+
+
+def stem(token: str) -> str:
+    """
+    Light plural stemmer - enough to line up 'categories' with 'category' and 'orders' with 'order'.
+    """
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 4 and token.endswith(("sses", "shes", "ches", "xes")):
+        return token[:-2]
+    if (
+        len(token) > 3
+        and token.endswith("s")
+        and not token.endswith(("ss", "us", "is"))
+    ):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text or an identifier into lowercase, stemmed tokens.
+    """
+    text = CAMEL_CASE_BOUNDARY.sub(" ", text)
+    return [stem(token) for token in TOKEN.findall(text.lower())]
+
+
+def parse_column_names(table_definition: str) -> List[str]:
+    """
+    Column names of a 'CREATE TABLE name (\\n column type,\\n ...\\n);' definition.
+    """
+    column_names = []
+    for line in table_definition.splitlines()[1:]:
+        line = line.strip()
+        if not line or line.startswith(")"):
+            continue
+        column_names.append(line.split()[0].strip('"'))
+    return column_names
+
+
+class TokenIndex:
+    """
+    Inverted index of table name and column name tokens.
+
+    A table scores the fraction of its name tokens found in the query, plus
+    COLUMN_MATCH_WEIGHT for every query token matching one of its column names,
+    weighted down by how many tables share that column token (so 'id' or
+    'created' barely count).
+    """
+
+    def __init__(self):
+        # token -> tables with the token in their name
+        self.name_postings: Dict[str, Set[str]] = {}
+        # token -> tables with the token in one of their column names
+        self.column_postings: Dict[str, Set[str]] = {}
+        # table -> (distinct name tokens, distinct column tokens)
+        self.table_tokens: Dict[str, Tuple[Set[str], Set[str]]] = {}
+
+    def __len__(self):
+        return len(self.table_tokens)
+
+    def add_table(self, table_name: str, column_names: List[str]):
+        """
+        Index a table, replacing what was indexed for it before.
+        """
+        self.remove_table(table_name)
+
+        name_tokens = set(tokenize(table_name))
+        column_tokens = set()
+        for column_name in column_names:
+            column_tokens.update(tokenize(column_name))
+
+        for token in name_tokens:
+            self.name_postings.setdefault(token, set()).add(table_name)
+        for token in column_tokens:
+            self.column_postings.setdefault(token, set()).add(table_name)
+
+        self.table_tokens[table_name] = (name_tokens, column_tokens)
+
+    def add_tables(self, map_table_name_to_table_def: Dict[str, str]):
+        """
+        Index tables from their 'CREATE TABLE' definitions.
+        """
+        for table_name, table_def in map_table_name_to_table_def.items():
+            self.add_table(table_name, parse_column_names(table_def))
+
+    def remove_table(self, table_name: str):
+        tokens = self.table_tokens.pop(table_name, None)
+        if tokens is None:
+            return
+
+        name_tokens, column_tokens = tokens
+        for postings, table_tokens in (
+            (self.name_postings, name_tokens),
+            (self.column_postings, column_tokens),
+        ):
+            for token in table_tokens:
+                postings[token].discard(table_name)
+                if not postings[token]:
+                    del postings[token]
+
+    def get_scores(self, query: str) -> Dict[str, float]:
+        """
+        Match scores of every table that shares at least one token with the query.
+        """
+        scores: Dict[str, float] = {}
+        n_tables = max(len(self.table_tokens), 1)
+
+        for token in set(tokenize(query)):
+            for table_name in self.name_postings.get(token, ()):
+                n_name_tokens = len(self.table_tokens[table_name][0])
+                scores[table_name] = scores.get(table_name, 0.0) + 1 / n_name_tokens
+
+            column_tables = self.column_postings.get(token, ())
+            if column_tables:
+                # idf style: full weight when one table has the token, none when all of them do
+                weight = COLUMN_MATCH_WEIGHT * math.log(n_tables / len(column_tables))
+                weight /= max(math.log(n_tables), 1)
+                for table_name in column_tables:
+                    scores[table_name] = scores.get(table_name, 0.0) + weight
+
+        return scores
+
+    def match(self, query: str) -> List[Tuple[str, float]]:
+        """
+        Tables matching the query as (table name, score), best first.
+        """
+        scores = self.get_scores(query)
+        return sorted(
+            ((name, score) for name, score in scores.items() if score > 0),
+            key=lambda item: (-item[1], item[0]),
+        )
+
+    def match_table_names(self, query: str) -> List[str]:
+        """
+        Tables whose every name token appears in the query, best first.
+        """
+        query_tokens = set(tokenize(query))
+        return [
+            table_name
+            for table_name, _ in self.match(query)
+            if self.table_tokens[table_name][0] <= query_tokens
+        ]
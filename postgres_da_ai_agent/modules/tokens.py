@@ -0,0 +1,42 @@
+"""
+Purpose:
+    Count tokens with tiktoken, without the OpenAI client - safe to import from offline tools.
+"""
+
+import functools
+import threading
+from typing import Dict
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+
+_encoders: Dict[str, tiktoken.Encoding] = {}
+_encoders_lock = threading.Lock()
+
+
+def get_encoder(model: str = "gpt-4") -> tiktoken.Encoding:
+    """
+    Get the tokenizer for a model, loaded once per process.
+    Models tiktoken doesn't know fall back to cl100k_base.
+    """
+    encoder = _encoders.get(model)
+    if encoder is not None:
+        return encoder
+
+    with _encoders_lock:
+        if model not in _encoders:
+            try:
+                _encoders[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encoders[model] = tiktoken.get_encoding(DEFAULT_ENCODING)
+        return _encoders[model]
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = "gpt-4"):
+    """
+    Count the number of tokens in a string.
+    Memoized - agents resend the same prompts and messages over and over.
+    """
+    return len(get_encoder(model).encode(text))
@@ -0,0 +1,152 @@
+"""
+Purpose:
+    Ledger of the token usage the OpenAI API reports back - chat completions and assistant runs.
+    Priced per model with separate input and output rates, so there's no tokenizing on the hot path.
+
+    Calls are attributed to the session and team set with `attribute()`:
+
+        with usage.attribute(session_id, team="data_eng"):
+            llm.prompt(...)
+
+        usage.ledger.get_session_totals(session_id)
+"""
+
+import contextlib
+import contextvars
+import threading
+from dataclasses import replace
+from typing import Any, Dict, Optional, Tuple
+
+from postgres_da_ai_agent.types import UsageTotals
+
+# USD per 1k (input tokens, output tokens) - https://openai.com/pricing
+MODEL_PRICES_PER_1K_TOKENS: Dict[str, Tuple[float, float]] = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4-1106-vision-preview": (0.01, 0.03),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+}
+
+# session id and team the current llm calls are billed to
+_session_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "usage_session_id", default=None
+)
+_team: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "usage_team", default=None
+)
+
+
+def price(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Cost in USD of a call, input and output tokens priced separately.
+    Models without a price are recorded at no cost.
+    """
+    if model not in MODEL_PRICES_PER_1K_TOKENS:
+        print(f"usage: no price for model {model}, recording tokens only")
+        return 0.0
+
+    input_price, output_price = MODEL_PRICES_PER_1K_TOKENS[model]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1000
+
+
+@contextlib.contextmanager
+def attribute(session_id: Optional[str] = None, team: Optional[str] = None):
+    """
+    Bill the llm calls made inside the block to a session and/or team.
+    """
+    session_token = _session_id.set(session_id or _session_id.get())
+    team_token = _team.set(team or _team.get())
+    try:
+        yield
+    finally:
+        _team.reset(team_token)
+        _session_id.reset(session_token)
+
+
+class UsageLedger:
+    """
+    Running usage totals - overall, per session and per team. Thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = UsageTotals()
+        self.totals_by_session: Dict[str, UsageTotals] = {}
+        self.totals_by_team: Dict[str, UsageTotals] = {}
+
+    def record(
+        self,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        session_id: Optional[str] = None,
+        team: Optional[str] = None,
+    ) -> float:
+        """
+        Record the tokens of one call. Session and team default to the ones set by attribute().
+        Returns the cost of the call.
+        """
+        session_id = session_id or _session_id.get()
+        team = team or _team.get()
+        cost = price(model, prompt_tokens, completion_tokens)
+
+        with self.lock:
+            totals = [self.totals]
+            if session_id is not None:
+                totals.append(
+                    self.totals_by_session.setdefault(session_id, UsageTotals())
+                )
+            if team is not None:
+                totals.append(self.totals_by_team.setdefault(team, UsageTotals()))
+
+            for total in totals:
+                total.prompt_tokens += prompt_tokens
+                total.completion_tokens += completion_tokens
+                total.cost += cost
+                total.calls += 1
+
+        return cost
+
+    def record_usage(
+        self,
+        model: str,
+        usage: Any,
+        session_id: Optional[str] = None,
+        team: Optional[str] = None,
+    ) -> float:
+        """
+        Record the `usage` of a chat completion or an assistants run. Missing usage costs nothing.
+        """
+        if usage is None:
+            return 0.0
+        return self.record(
+            model,
+            usage.prompt_tokens or 0,
+            usage.completion_tokens or 0,
+            session_id,
+            team,
+        )
+
+    def get_totals(self) -> UsageTotals:
+        with self.lock:
+            return replace(self.totals)
+
+    def get_session_totals(self, session_id: str) -> UsageTotals:
+        with self.lock:
+            return replace(self.totals_by_session.get(session_id, UsageTotals()))
+
+    def get_team_totals(self, team: str) -> UsageTotals:
+        with self.lock:
+            return replace(self.totals_by_team.get(team, UsageTotals()))
+
+    def pop_session_totals(self, session_id: str) -> UsageTotals:
+        """
+        Totals of a finished session, forgetting them - long running servers
+        would otherwise keep an entry for every request.
+        """
+        with self.lock:
+            return self.totals_by_session.pop(session_id, UsageTotals())
+
+
+# process wide ledger
+ledger = UsageLedger()
@@ -6,7 +6,11 @@ from postgres_da_ai_agent.agents.instruments import PostgresAgentInstruments
 from postgres_da_ai_agent.modules import llm
 from postgres_da_ai_agent.modules import rand
 from postgres_da_ai_agent.modules import embeddings
+from postgres_da_ai_agent.modules import response_cache
+from postgres_da_ai_agent.modules import usage
 import argparse
+import psycopg2
+from psycopg2.pool import PoolError
 
 DB_URL = os.environ.get("DATABASE_URL")
 POSTGRES_TABLE_DEFINITIONS_CAP_REF = "TABLE_DEFINITIONS"
@@ -70,6 +74,31 @@ def main():
     with PostgresAgentInstruments(DB_URL, session_id) as (agent_instruments, db):
         database_embedder = embeddings.DatabaseEmbedder(db)
 
+        # repeated prompts skip the assistant and go straight to run_sql
+        cache = response_cache.get_response_cache()
+        schema_fingerprint = db.get_schema_fingerprint()
+
+        # only embedded on an exact miss when the similarity tier is on
+        cached = cache.get(
+            raw_prompt,
+            schema_fingerprint,
+            lambda: database_embedder.get_query_embedding(raw_prompt),
+        )
+        if cached is not None:
+            cached_key, cached_sql = cached
+            try:
+                agent_instruments.run_sql(cached_sql)
+                print(f"✅ Response cache hit, ran the cached SQL.")
+                return
+            except PoolError:
+                # no connection to be had - not a problem with the cached SQL
+                raise
+            except psycopg2.Error as e:
+                print(f"Cached SQL failed, regenerating: {e}")
+                db.conn.rollback()
+                cache.delete(cached_key)
+
+        # packed into TABLE_DEFINITIONS_TOKEN_BUDGET tokens, see modules/context_builder.py
         table_definitions = database_embedder.get_similar_table_defs_for_prompt(
             raw_prompt
         )
@@ -85,28 +114,43 @@ def main():
             TurboTool("run_sql", run_sql_tool_config, agent_instruments.run_sql),
         ]
 
-        (
-            assistant.get_or_create_assistant(assistant_name)
-            .set_instructions(
-                "You're an elite SQL developer. You generate the most concise and performant SQL queries."
-            )
-            .equip_tools(tools)
-            .make_thread()
-            .add_message(prompt)
-            .run_thread()
-            .add_message(
-                "Use the run_sql function to run the SQL you've just generated.",
-            )
-            .run_thread(toolbox=[tools[0].name])
-            .run_validation(agent_instruments.validate_run_sql)
-            .spy_on_assistant(agent_instruments.make_agent_chat_file(assistant_name))
-            .get_costs_and_tokens(
-                agent_instruments.make_agent_cost_file(assistant_name)
+        with usage.attribute(session_id, team=assistant_name):
+            (
+                assistant.get_or_create_assistant(assistant_name)
+                .set_instructions(
+                    "You're an elite SQL developer. You generate the most concise and performant SQL queries."
+                )
+                .equip_tools(tools)
+                .make_thread()
+                .add_message(prompt)
+                .run_thread()
+                .add_message(
+                    "Use the run_sql function to run the SQL you've just generated.",
+                )
+                .run_thread(toolbox=[tools[0].name])
+                .run_validation(agent_instruments.validate_run_sql)
+                .spy_on_assistant(
+                    agent_instruments.make_agent_chat_file(assistant_name)
+                )
+                .get_costs_and_tokens(
+                    agent_instruments.make_agent_cost_file(assistant_name)
+                )
             )
-        )
 
         print(f"✅ Turbo4 Assistant finished.")
 
+        if agent_instruments.validate_run_sql()[0]:
+            # the embedder already holds the prompt embedding if the lookup computed it
+            prompt_embedding = (
+                database_embedder.get_query_embedding(raw_prompt)
+                if cache.similarity_threshold is not None
+                else None
+            )
+            with open(agent_instruments.sql_query_file, "r") as f:
+                cache.put(raw_prompt, schema_fingerprint, f.read(), prompt_embedding)
+
+        print(f"Usage: {usage.ledger.get_session_totals(session_id)}")
+
         # ---------- Simple Prompt Solution - Same thing, only 2 api calls instead of 8+ ------------
         # sql_response = llm.prompt(
         #     prompt,
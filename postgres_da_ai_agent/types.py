@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Callable, List
+from typing import Callable, Dict, List, Optional
 from dataclasses import dataclass, field
 import time
 
@@ -27,3 +27,54 @@ class TurboTool:
     name: str
     config: dict
     function: Callable
+
+
+@dataclass
+class TableColumn:
+    name: str
+    data_type: str
+    not_null: bool
+    position: int
+    comment: Optional[str] = None
+    primary_key: bool = False
+    # table referenced by a foreign key on this column
+    foreign_table: Optional[str] = None
+
+
+@dataclass
+class ForeignKey:
+    table_name: str
+    column_names: List[str]
+    foreign_table_name: str
+    foreign_column_names: List[str]
+
+
+@dataclass
+class SchemaSnapshot:
+    fingerprint: str
+    table_columns: Dict[str, List[TableColumn]]
+    table_definitions: Dict[str, str]
+    table_comments: Dict[str, str] = field(default_factory=dict)
+    foreign_keys: List[ForeignKey] = field(default_factory=list)
+
+
+@dataclass
+class TableDefinitionsContext:
+    table_definitions: str
+    tokens: int
+    token_budget: int
+    included: List[str]
+    shortened: List[str]
+    dropped: List[str]
+
+
+@dataclass
+class UsageTotals:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    calls: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens